@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the pytheon API used by the benchmarks.
+
+Run it alone with::
+
+    $ python benchmarks/fakeapi.py --port 6543 --latency 0.02
+
+then set ``api_host = 127.0.0.1:6543`` in ``~/.pytheonrc``.
+"""
+from __future__ import with_statement
+import re
+import ssl
+import sys
+import time
+import zlib
+import json
+import threading
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment. Avoid Nagle/delayed ACK stalls
+    wbufsize = -1
+
+    routes = [
+        ('GET', r'^/v1/applications$', 'applications'),
+        ('POST', r'^/v1/applications$', 'create'),
+        ('DELETE', r'^/v1/applications/(?P<name>[^/]+)$', 'delete'),
+        ('GET', r'^/v1/applications/(?P<name>[^/]+)/addons$', 'app_addons'),
+        ('POST', r'^/v1/applications/(?P<name>[^/]+)/addons$', 'add_addon'),
+        ('GET', r'^/v1/addons$', 'addons'),
+        ('POST', r'^/v1/account/keys$', 'add_key'),
+        ('GET', r'^/v1/large$', 'large'),
+    ]
+
+    def applications(self):
+        if 'application/json' in self.headers.get('Accept', ''):
+            return json.dumps([dict(name='app-%05d' % i,
+                                    addons=['mysql', 'memcached'])
+                               for i in range(self.server.applications)])
+        return ''.join(['- app-%05d\n' % i
+                        for i in range(self.server.applications)])
+
+    def create(self):
+        return 'Application created\n'
+
+    def delete(self, name):
+        return 'Application deleted\n'
+
+    def app_addons(self, name):
+        return '- mysql\n- memcached\n'
+
+    def add_addon(self, name):
+        return 'Addon added\n'
+
+    def addons(self):
+        return '- mysql\n- postgresql\n- memcached\n- redis\n'
+
+    def add_key(self):
+        return 'Key added\n'
+
+    def large(self):
+        line = 'x' * 79 + '\n'
+        return line * (self.server.payload_size / len(line))
+
+    def handle_request(self):
+        self.server.count()
+        if self.command in ('POST', 'PUT'):
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.path.split('?', 1)[0]
+        for method, regex, name in self.routes:
+            match = re.match(regex, path)
+            if match and method == self.command:
+                body = getattr(self, name)(**match.groupdict())
+                return self.respond(200, body)
+        self.respond(404, '! Not found\n')
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def respond(self, status, body):
+        content_type = 'text/plain'
+        if body[:1] in ('[', '{'):
+            content_type = 'application/json'
+        headers = [('Content-Type', content_type),
+                   ('Set-Cookie', 'auth_tkt=benchmark; Path=/')]
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and \
+           len(body) > 1024:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPI(ThreadingMixIn, HTTPServer):
+    """Fake API server. ``latency`` is added to each response,
+    ``applications`` is the size of the application listing and
+    ``payload_size`` the size of /v1/large in bytes"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, applications=10,
+                 payload_size=1024 * 1024, certfile=None, keyfile=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.applications = applications
+        self.payload_size = payload_size
+        self.requests = 0
+        self.lock = threading.Lock()
+        if certfile:
+            self.socket = ssl.wrap_socket(self.socket, server_side=True,
+                                          certfile=certfile, keyfile=keyfile)
+
+    @property
+    def host(self):
+        return '%s:%s' % self.server_address
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-p', '--port', type='int', default=6543)
+    parser.add_option('-l', '--latency', type='float', default=0,
+                      help='Seconds added to each response')
+    parser.add_option('-a', '--applications', type='int', default=10,
+                      help='Number of applications listed')
+    parser.add_option('--certfile', default=None,
+                      help='Serve HTTPS with this certificate')
+    parser.add_option('--keyfile', default=None)
+    options, args = parser.parse_args()
+    server = FakeAPI(options.port, options.latency, options.applications,
+                     certfile=options.certfile, keyfile=options.keyfile)
+    print 'Serving on %s' % server.host
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+if __name__ == '__main__':
+    main()
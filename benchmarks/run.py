@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the pytheon CLI against a local fake API.
+
+Usage::
+
+    $ python benchmarks/run.py --output results.json
+    $ python benchmarks/run.py --compare results.json
+
+Results are written as JSON. With ``--compare`` the run fails if a
+benchmark is slower than the baseline by more than ``--tolerance``.
+"""
+from __future__ import with_statement
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeapi import FakeAPI
+
+
+def stats(timings, unit='s', **extra):
+    timings = sorted(timings)
+    result = dict(
+        unit=unit,
+        runs=len(timings),
+        min=timings[0],
+        median=timings[len(timings) / 2],
+        p95=timings[min(int(len(timings) * .95), len(timings) - 1)],
+        max=timings[-1],
+    )
+    result.update(extra)
+    return result
+
+
+def json_listing(size):
+    """a synthetic listing of applications with their addons"""
+    return dict(applications=[
+        dict(name='app-%05d' % i,
+             owner=dict(email='user%s@example.com' % i),
+             addons=[dict(name=n, plan='free')
+                     for n in ('mysql', 'memcached', 'redis')])
+        for i in range(size)])
+
+
+def walk_json(obj):
+    """touch every addon of every application"""
+    names = 0
+    for app in obj.applications:
+        for addon in app.addons:
+            if app.owner.email and addon.name:
+                names += 1
+    return names
+
+
+def timeit(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+class Benchmarks(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.home = tempfile.mkdtemp(prefix='pytheon-bench-')
+        self.server = FakeAPI(latency=options.latency,
+                              applications=options.applications,
+                              payload_size=options.payload_size).start()
+        with open(os.path.join(self.home, '.pytheonrc'), 'w') as fd:
+            fd.write('[pytheon]\n'
+                     'api_host = %s\n'
+                     'username = bench@example.com\n'
+                     'auth_cookie = benchmark\n'
+                     'cache = false\n' % self.server.host)
+        self.env = dict(os.environ, HOME=self.home, PYTHONPATH=root)
+        os.environ['HOME'] = self.home
+
+    def close(self):
+        self.server.stop()
+        shutil.rmtree(self.home)
+
+    def python(self, code):
+        subprocess.check_call([sys.executable, '-c', code], env=self.env,
+                              stdout=open(os.devnull, 'w'))
+
+    def bench_startup_import(self):
+        """cold import of pytheon.main in a new interpreter"""
+        return stats(timeit(lambda: self.python('import pytheon.main'),
+                            self.options.repeat))
+
+    def bench_startup_cli(self):
+        """cold `pytheon apps -l` in a new interpreter"""
+        code = 'from pytheon.main import main; main(["apps", "-l"])'
+        return stats(timeit(lambda: self.python(code), self.options.repeat))
+
+    def bench_request_latency(self):
+        """one GET on a warm connection"""
+        from pytheon import http
+        http.request('/v1/addons')
+        return stats(timeit(lambda: http.request('/v1/addons'),
+                            self.options.requests))
+
+    def bench_sequential_requests(self):
+        """N sequential GET"""
+        from pytheon import http
+        n = self.options.requests
+
+        def run():
+            for i in range(n):
+                http.request('/v1/applications/app-%05d/addons' % i)
+        timings = timeit(run, self.options.repeat)
+        return stats(timings, requests=n,
+                     requests_per_second=n / min(timings))
+
+    def bench_concurrent_requests(self):
+        """N GET with http.request_many"""
+        from pytheon import http
+        n = self.options.requests
+        paths = ['/v1/applications/app-%05d/addons' % i for i in range(n)]
+        timings = timeit(lambda: http.request_many(paths),
+                         self.options.repeat)
+        return stats(timings, requests=n,
+                     requests_per_second=n / min(timings))
+
+    def bench_batch(self):
+        """N commands with `pytheon batch`"""
+        from pytheon import commands
+        n = self.options.requests
+        filename = os.path.join(self.home, 'batch.txt')
+        with open(filename, 'w') as fd:
+            for i in range(n):
+                fd.write('apps --delete app-%05d\n' % i)
+        timings = timeit(lambda: commands.batch([filename]),
+                         self.options.repeat)
+        return stats(timings, commands=n,
+                     commands_per_second=n / min(timings))
+
+    def bench_large_response(self):
+        """GET of a large body"""
+        from pytheon import http
+        size = self.options.payload_size
+        timings = timeit(lambda: http.request('/v1/large'),
+                         self.options.repeat)
+        return stats(timings, bytes=size,
+                     mb_per_second=size / min(timings) / 1024 / 1024)
+
+    def bench_large_response_stream(self):
+        """streamed GET of a large body"""
+        from pytheon import http
+        size = self.options.payload_size
+
+        def run():
+            for line in http.request('/v1/large', stream=True):
+                pass
+        timings = timeit(run, self.options.repeat)
+        return stats(timings, bytes=size,
+                     mb_per_second=size / min(timings) / 1024 / 1024)
+
+    def bench_large_listing(self):
+        """`apps -l` with a large account"""
+        from pytheon import commands
+        self.server.applications = self.options.large_applications
+        try:
+            timings = timeit(lambda: list(commands.apps(['-l'])),
+                             self.options.repeat)
+        finally:
+            self.server.applications = self.options.applications
+        return stats(timings, applications=self.options.large_applications)
+
+    def bench_large_listing_json(self):
+        """JSON listing of a large account decoded at once"""
+        from pytheon import http
+        self.server.applications = self.options.large_applications
+        try:
+            timings = timeit(lambda: len(http.request('/v1/applications',
+                                                      json=True)),
+                             self.options.repeat)
+        finally:
+            self.server.applications = self.options.applications
+        return stats(timings, applications=self.options.large_applications)
+
+    def bench_large_listing_iter_json(self):
+        """JSON listing of a large account decoded with http.iter_json"""
+        from pytheon import http
+        self.server.applications = self.options.large_applications
+        try:
+            timings = timeit(lambda: len(list(http.iter_json(
+                                                '/v1/applications'))),
+                             self.options.repeat)
+        finally:
+            self.server.applications = self.options.applications
+        return stats(timings, applications=self.options.large_applications)
+
+    def walk_json(self, cls):
+        """walk a new wrapper of the listing (cold). The median time of a
+        second walk on the same wrapper is reported as ``warm_median``"""
+        size = self.options.large_applications
+        data = json_listing(size)
+        obj = cls(data)
+        walk_json(obj)
+        warm = stats(timeit(lambda: walk_json(obj), self.options.repeat))
+        timings = timeit(lambda: walk_json(cls(data)), self.options.repeat)
+        return stats(timings, applications=size, warm_median=warm['median'])
+
+    def bench_json_copy(self):
+        """walk a large decoded listing with utils.JSON, which copies nested
+        values on each attribute access"""
+        from pytheon import utils
+        return self.walk_json(utils.JSON)
+
+    def bench_json_view(self):
+        """walk a large decoded listing with utils.JSONView"""
+        from pytheon import utils
+        return self.walk_json(utils.JSONView)
+
+    def names(self):
+        return sorted([n[6:] for n in dir(self) if n.startswith('bench_')])
+
+    def run(self, names=None):
+        import logging
+        # command output is not part of the benchmarks
+        logging.getLogger().setLevel(logging.ERROR)
+        results = {}
+        for name in names or self.names():
+            func = getattr(self, 'bench_%s' % name)
+            start = time.time()
+            results[name] = func()
+            results[name]['description'] = func.__doc__
+            print >> sys.stderr, '%-25s %8.2fms (%.1fs)' % (
+                        name, results[name]['median'] * 1000,
+                        time.time() - start)
+        return dict(python=sys.version.split()[0], platform=sys.platform,
+                    latency=self.options.latency, date=time.time(),
+                    benchmarks=results)
+
+
+def compare(results, baseline, tolerance):
+    """return a list of benchmarks slower than baseline"""
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['median']
+        after = result['median']
+        if after > before * (1 + tolerance):
+            regressions.append('%s: %.2fms -> %.2fms' % (
+                                name, before * 1000, after * 1000))
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-o', '--output', default=None,
+                      help='Write JSON results to this file (default stdout)')
+    parser.add_option('-c', '--compare', default=None, metavar='FILE',
+                      help='Fail if slower than the results in FILE')
+    parser.add_option('-t', '--tolerance', type='float', default=.2,
+                      help='Allowed slowdown ratio with --compare')
+    parser.add_option('-r', '--repeat', type='int', default=5)
+    parser.add_option('-n', '--requests', type='int', default=50,
+                      help='Number of requests/commands per run')
+    parser.add_option('-l', '--latency', type='float', default=0,
+                      help='Seconds added by the fake API to each response')
+    parser.add_option('-a', '--applications', type='int', default=10)
+    parser.add_option('--large-applications', type='int', default=20000)
+    parser.add_option('-s', '--payload-size', type='int',
+                      default=4 * 1024 * 1024)
+    parser.add_option('--list', action='store_true', default=False,
+                      help='List benchmarks')
+    options, args = parser.parse_args()
+
+    benchmarks = Benchmarks(options)
+    try:
+        if options.list:
+            for name in benchmarks.names():
+                func = getattr(benchmarks, 'bench_' + name)
+                print '%-25s %s' % (name, func.__doc__)
+            return
+        results = benchmarks.run(args)
+    finally:
+        benchmarks.close()
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            fd.write(data)
+    else:
+        print data
+
+    if options.compare:
+        with open(options.compare) as fd:
+            baseline = json.load(fd)
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION %s' % regression
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
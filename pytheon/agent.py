@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""A local agent keeping the configuration, the credentials and the HTTP
+connection pool of pytheon in memory, like ssh-agent does for keys.
+
+``pytheon agent`` starts it in the background. Then :func:`pytheon.main.main`
+forwards commands to it through a UNIX socket. The socket is
+``$PYTHEON_AGENT_SOCK`` or ``~/.pytheon/agent.sock``. Set
+``PYTHEON_NO_AGENT=1`` to run a command in process.
+
+Messages are JSON objects, one per line. The client sends ``{"args": [...],
+"cwd": ..., "env": {...}}``. The agent answers with ``{"output": ...}``
+messages, ``{"prompt": ..., "default": ..., "password": ...}`` when the
+command asks for some input (the client answers ``{"input": ...}``) and a
+final ``{"exit": status}``. ``{"ping": true}`` and ``{"stop": true}`` are
+answered with ``{"pid": ...}``.
+
+Commands run one at a time, in the working directory and with the
+environment of the client. Only the commands of :data:`FORWARDED` are run
+by the agent: other commands need the terminal or the stdin of the client
+(``shell``, ``deploy``, ``batch -``...).
+"""
+from __future__ import with_statement
+import os
+import sys
+import socket
+import signal
+import logging
+from pytheon.compat import json
+
+log = logging.getLogger(__name__)
+
+# seconds without command before the agent exits
+IDLE_TIMEOUT = 3600
+
+# commands which need no terminal nor stdin
+FORWARDED = ('apps', 'addons', 'add_key', 'batch')
+
+
+def socket_path():
+    return os.environ.get('PYTHEON_AGENT_SOCK') or \
+           os.path.expanduser('~/.pytheon/agent.sock')
+
+
+def files(sock):
+    """return buffered file to read messages and an unbuffered one to send
+    them"""
+    return sock.makefile('rb', -1), sock.makefile('wb', 0)
+
+
+def send(fd, **message):
+    fd.write(json.dumps(message) + '\n')
+    fd.flush()
+
+
+def receive(fd):
+    line = fd.readline()
+    if not line:
+        raise EOFError('Connection closed by the agent')
+    return json.loads(line)
+
+
+def connect(path=None):
+    """return a socket connected to the agent or None if no agent is
+    running"""
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # a stale socket file
+        sock.close()
+        return None
+    return sock
+
+
+def call(path=None, **message):
+    """send a control message and return the answer or None if no agent is
+    running"""
+    sock = connect(path)
+    if sock is None:
+        return None
+    try:
+        rfile, wfile = files(sock)
+        send(wfile, **message)
+        return receive(rfile)
+    except (socket.error, EOFError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def ping(path=None):
+    """return the pid of the running agent or None"""
+    answer = call(path, ping=True)
+    return answer and answer.get('pid') or None
+
+
+def forwardable(args, cwd=None):
+    """True if the command can run in the agent. A batch is forwarded only
+    if all its commands can run in the agent. Relative filenames are relative
+    to cwd"""
+    if not args or args[0] not in FORWARDED:
+        return False
+    if args[0] != 'batch':
+        return True
+    filenames = [a for a in args[1:] if not a.startswith('-')]
+    if '-' in args[1:] or len(filenames) != 1:
+        # commands are read from the stdin of the client
+        return False
+    from pytheon import commands
+    try:
+        with open(os.path.join(cwd or os.getcwd(), filenames[0])) as fd:
+            lines = list(commands.parse_batch(fd))
+    except (IOError, ValueError, KeyError):
+        # the error is reported by the client
+        return False
+    for line in lines:
+        if line[0] == 'batch' or not forwardable(line):
+            return False
+    return True
+
+
+def forward(args, path=None, out=None):
+    """run a command in the agent. Output is written to out (default
+    stdout). Return the exit status of the command or None if no agent is
+    running"""
+    if os.environ.get('PYTHEON_NO_AGENT') or not forwardable(args):
+        return None
+    sock = connect(path)
+    if sock is None:
+        return None
+    out = out or sys.stdout
+    try:
+        rfile, wfile = files(sock)
+        send(wfile, args=list(args), cwd=os.getcwd(), env=dict(os.environ))
+        while True:
+            message = receive(rfile)
+            if 'output' in message:
+                out.write(message['output'].encode('utf-8'))
+                out.flush()
+            elif 'prompt' in message:
+                from pytheon import utils
+                value = utils.get_input(message['prompt'],
+                                        message.get('default'),
+                                        message.get('password'))
+                send(wfile, input=value)
+            elif 'exit' in message:
+                return message['exit']
+    except (socket.error, EOFError, ValueError), e:
+        print >> sys.stderr, 'Lost connection to the agent: %s' % e
+        return 1
+    finally:
+        sock.close()
+
+
+def exit_status(code):
+    """convert a SystemExit code to an exit status"""
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    return 1
+
+
+class Output(object):
+    """A file sending what is written to the client"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        send(self.fd, output=data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class Stdout(object):
+    """Write to the current sys.stdout. Used by the log handler of the
+    agent so output goes to the client of the running command"""
+
+    def write(self, data):
+        sys.stdout.write(data)
+
+    def flush(self):
+        sys.stdout.flush()
+
+
+class Agent(object):
+    """The agent server. Connections are handled one at a time"""
+
+    def __init__(self, path=None, idle_timeout=IDLE_TIMEOUT):
+        self.path = path or socket_path()
+        self.idle_timeout = idle_timeout
+        self.running = False
+        self.sock = None
+
+    def bind(self):
+        """create the socket. Only the user can access it"""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+
+    def warm_up(self):
+        """load what is reused by all commands"""
+        from pytheon import utils
+        from pytheon import http
+        utils.user_config()
+        with http.auth_lock:
+            http.auth_cookie()
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        handler = logging.StreamHandler(Stdout())
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root = logging.getLogger()
+        handlers, root.handlers = root.handlers, [handler]
+        try:
+            self.warm_up()
+        except Exception:
+            log.debug('Unable to warm up', exc_info=True)
+        self.running = True
+        self.sock.settimeout(self.idle_timeout)
+        try:
+            while self.running:
+                try:
+                    conn, address = self.sock.accept()
+                except socket.timeout:
+                    break
+                conn.settimeout(None)
+                try:
+                    self.handle(conn)
+                except Exception:
+                    log.debug('Error in agent', exc_info=True)
+                finally:
+                    conn.close()
+        finally:
+            root.handlers = handlers
+            self.close()
+
+    def close(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def handle(self, conn):
+        rfile, wfile = files(conn)
+        message = receive(rfile)
+        if message.get('ping'):
+            send(wfile, pid=os.getpid())
+        elif message.get('stop'):
+            self.running = False
+            send(wfile, pid=os.getpid())
+        elif 'args' in message:
+            if forwardable(message['args'], message.get('cwd')):
+                status = self.run_command(rfile, wfile, message)
+            else:
+                send(wfile, output=u'This command can not run in the agent\n')
+                status = 1
+            send(wfile, exit=status)
+
+    def run_command(self, rfile, wfile, message):
+        """run a command with the working directory, the environment and the
+        output of the client. Return the exit status"""
+        from pytheon import main
+        from pytheon import utils
+        args = [str(a) for a in message['args']]
+        saved = (os.getcwd(), dict(os.environ), sys.stdout, sys.stderr)
+        sys.argv[0] = 'pytheon'
+
+        def prompt(text, default=None, password=None):
+            send(wfile, prompt=text, default=default, password=password)
+            return receive(rfile)['input']
+
+        root = logging.getLogger()
+        root.setLevel('--verbose' in args and logging.DEBUG or logging.INFO)
+        status = 0
+        try:
+            os.chdir(message.get('cwd') or saved[0])
+            os.environ.clear()
+            os.environ.update(message.get('env') or saved[1])
+            sys.stdout = sys.stderr = Output(wfile)
+            utils.input_hook = prompt
+            main.dispatch(args)
+        except SystemExit, e:
+            status = exit_status(e.code)
+        except Exception:
+            log.exception('Error while running %s', ' '.join(args))
+            status = 1
+        finally:
+            utils.input_hook = None
+            sys.stdout, sys.stderr = saved[2:]
+            os.environ.clear()
+            os.environ.update(saved[1])
+            os.chdir(saved[0])
+        return status
+
+
+def daemonize(logfile=os.devnull):
+    """fork in the background. Return the pid of the child in the parent
+    and None in the child"""
+    pid = os.fork()
+    if pid:
+        return pid
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDONLY)
+    out = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+    os.dup2(null, 0)
+    os.dup2(out, 1)
+    os.dup2(out, 2)
+    return None
+
+
+def start(path=None, foreground=False, idle_timeout=IDLE_TIMEOUT):
+    """start an agent unless one is already running. Return a message for
+    the user"""
+    path = path or socket_path()
+    pid = ping(path)
+    if pid:
+        return 'Agent already running on %s (pid %s)' % (path, pid)
+    agent = Agent(path, idle_timeout)
+    agent.bind()
+    if not foreground:
+        pid = daemonize(os.path.join(os.path.dirname(path), 'agent.log'))
+        if pid:
+            agent.sock.close()
+            return 'Agent listening on %s (pid %s)' % (path, pid)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        agent.serve_forever()
+    finally:
+        if not foreground:
+            os._exit(0)
+    return 'Agent stopped'
+
+
+def stop(path=None):
+    answer = call(path, stop=True)
+    if answer is None:
+        return 'No agent running'
+    return 'Agent stopped (pid %s)' % answer['pid']
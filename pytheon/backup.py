@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""Database backups. The dump program (mysqldump or pg_dump) is spawned
+without a shell and its output is compressed while it is read. The backup
+is only renamed to its final name once both the dump and the compression
+succeeded. Incremental backups go to a deduplicated
+:class:`pytheon.store.ChunkStore`"""
+from __future__ import with_statement
+import os
+import time
+import zlib
+import Queue
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from distutils.spawn import find_executable
+from pytheon import utils
+from pytheon.compat import json
+from pytheon.store import ChunkStore, StoreError, expired, dated_backups
+from pytheon.store import retention_policy
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+# name: (extension, command line). gzip is done in process with zlib
+COMPRESSORS = {
+    'pigz': ('.gz', ['pigz', '-c', '-%(level)s']),
+    'zstd': ('.zst', ['zstd', '-q', '-c', '-T0', '-%(level)s']),
+    'lz4': ('.lz4', ['lz4', '-q', '-c', '-%(level)s']),
+    'gzip': ('.gz', None),
+}
+LEVELS = dict(pigz=6, zstd=3, lz4=1, gzip=6)
+
+
+class BackupError(RuntimeError):
+    """A stage of a backup failed"""
+
+
+class ZlibStream(object):
+    """gzip in process. Used when no compression program is available"""
+
+    def __init__(self, fd, level):
+        self.fd = fd
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.fd.write(self.obj.compress(data))
+
+    def close(self):
+        self.fd.write(self.obj.flush())
+
+
+class ProcessStream(object):
+    """compress with a program reading stdin and writing to fd"""
+
+    def __init__(self, args, fd):
+        self.args = args
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=fd, close_fds=True,
+                                        bufsize=CHUNK_SIZE)
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except IOError, e:
+            raise BackupError('%s failed: %s' % (self.args[0], e))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        status = self.process.wait()
+        if status != 0:
+            raise BackupError('%s exited with status %s' % (self.args[0],
+                                                           status))
+
+
+class Compressor(object):
+    """A compression method. :meth:`open` returns a stream compressing
+    what is written to it into a file"""
+
+    def __init__(self, name, extension, args=None, level=6):
+        self.name = name
+        self.extension = extension
+        self.args = args
+        self.level = level
+
+    def open(self, fd):
+        if self.args is None:
+            return ZlibStream(fd, self.level)
+        return ProcessStream(self.args, fd)
+
+    def __repr__(self):
+        return '<Compressor %s -%s>' % (self.name, self.level)
+
+
+def get_compressor(name=None, level=None):
+    """return the :class:`Compressor` named ``backup_compressor`` in
+    ``~/.pytheonrc``. ``auto`` (the default) uses pigz, a multi-threaded
+    gzip, when it's installed. Missing programs are replaced by zlib"""
+    config = utils.user_config()
+    name = name or config.pytheon.backup_compressor or 'auto'
+    if name == 'auto':
+        name = find_executable('pigz') and 'pigz' or 'gzip'
+    if name not in COMPRESSORS:
+        raise BackupError('Unknown compressor %r. Valid compressors are %s'
+                          % (name, ', '.join(sorted(COMPRESSORS))))
+    extension, args = COMPRESSORS[name]
+    if args is not None and not find_executable(args[0]):
+        log.warn('%s is not installed. Using zlib', args[0])
+        name = 'gzip'
+        extension, args = COMPRESSORS[name]
+    level = int(level or config.pytheon.backup_compress_level or LEVELS[name])
+    if args is not None:
+        args = [a % dict(level=level) for a in args]
+    return Compressor(name, extension, args, level)
+
+
+def format_size(size):
+    return '%.1fMB' % (size / 1024. / 1024.)
+
+
+def dump(args, filename, compressor, env=None):
+    """run the dump program ``args`` and compress its output to filename.
+    The file is written atomically and only readable by the user. Raise
+    :class:`BackupError` if the dump or the compression fails. Return a dict
+    with the dumped and written sizes, the sha256 of the dump and the
+    duration"""
+    start = time.time()
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(filename),
+                               dir=dirname)
+    errors = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    raw = 0
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            try:
+                dumper = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                          stderr=errors, env=env,
+                                          close_fds=True, bufsize=CHUNK_SIZE)
+            except OSError, e:
+                raise BackupError('Can not run %s: %s' % (args[0], e))
+            stream = compressor.open(output)
+            try:
+                read = dumper.stdout.read
+                while True:
+                    chunk = read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    raw += len(chunk)
+                    digest.update(chunk)
+                    stream.write(chunk)
+            finally:
+                # closing the pipe stops the dump if the compression failed
+                dumper.stdout.close()
+                status = dumper.wait()
+            stream.close()
+            if status != 0:
+                errors.seek(0)
+                raise BackupError('%s exited with status %s: %s' % (
+                                  args[0], status, errors.read().strip()))
+            output.flush()
+            os.fsync(output.fileno())
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        errors.close()
+    stats = dict(raw=raw, size=os.path.getsize(filename),
+                 sha256=digest.hexdigest(), seconds=time.time() - start)
+    log.info('%s: dumped %s, wrote %s (%.0f%%) in %.1fs (%.1fMB/s)',
+             filename, format_size(stats['raw']), format_size(stats['size']),
+             stats['size'] * 100. / max(stats['raw'], 1), stats['seconds'],
+             stats['raw'] / 1024. / 1024. / max(stats['seconds'], .001))
+    return stats
+
+
+def mysql_defaults(data):
+    """write the password to a temporary option file so it's not visible in
+    the process list. Return the filename"""
+    fd, filename = tempfile.mkstemp(prefix='pytheon-', suffix='.cnf')
+    password = (data.get('password') or '').replace('\\', '\\\\')
+    with os.fdopen(fd, 'w') as fileobj:
+        fileobj.write('[client]\npassword="%s"\n' %
+                      password.replace('"', '\\"'))
+    return filename
+
+
+def dump_command(data, defaults_file=None, options=(), tables=(),
+                 clean=True):
+    """return the command line and the environment used to dump the
+    database described by data (see :func:`pytheon.utils.engine_dict`).
+    ``options`` are added to the default options. Only ``tables`` are dumped
+    if any. With ``clean`` the dump drops tables before creating them"""
+    driver = data.get('drivername') or ''
+    env = dict(os.environ)
+    if driver.startswith('mysql'):
+        args = ['mysqldump']
+        if defaults_file:
+            args.append('--defaults-extra-file=%s' % defaults_file)
+        if clean:
+            args.append('--add-drop-table')
+        args.extend(['-u', data['username'], '-h', data['host']])
+        if data.get('port'):
+            args.extend(['-P', str(data['port'])])
+        args.extend(options)
+        args.append(data['database'])
+        args.extend(tables)
+    elif driver.startswith('postgresql'):
+        args = ['pg_dump'] + (clean and ['-c'] or []) + \
+               ['-w', '-U', data['username']]
+        if data.get('password'):
+            env['PGPASSWORD'] = data['password']
+        args.extend(options)
+        for table in tables:
+            args.extend(['-t', '"%s"' % table.replace('"', '""')])
+        args.append(data['database'])
+    else:
+        raise BackupError('Can not backup %r databases' % driver)
+    return args, env
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_tables(engine):
+    try:
+        from sqlalchemy import inspect
+    except ImportError:
+        return engine.table_names()
+    return inspect(engine).get_table_names()
+
+
+class Snapshot(object):
+    """Make per-table dumps consistent. PostgreSQL exports a snapshot used
+    by each pg_dump (``--snapshot``). MySQL holds a global read lock until
+    all tables are dumped, so writes wait for the end of the backup. Set
+    ``backup_consistent = false`` in ``~/.pytheonrc`` to disable it"""
+
+    def __init__(self, engine, driver, enabled=True):
+        self.engine = engine
+        self.driver = driver
+        self.enabled = enabled
+        self.conn = self.trans = None
+        self.id = None
+        self.consistent = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        try:
+            self.conn = self.engine.connect()
+            if self.driver.startswith('postgresql'):
+                self.trans = self.conn.begin()
+                self.conn.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                self.id = self.conn.execute(
+                    'SELECT pg_export_snapshot()').scalar()
+            else:
+                self.conn.execute('FLUSH TABLES WITH READ LOCK')
+            self.consistent = True
+        except Exception, e:
+            log.warn('Tables will be dumped without a common snapshot: %s',
+                     e)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.conn is not None:
+            try:
+                if self.trans is not None:
+                    self.trans.rollback()
+                elif self.consistent:
+                    self.conn.execute('UNLOCK TABLES')
+            finally:
+                self.conn.close()
+        return False
+
+
+def table_commands(data, tables, defaults_file=None, snapshot=None):
+    """return ``(name, args, env)`` for each dump of a per-table backup.
+    With PostgreSQL the schema is dumped apart (``_schema``) and tables only
+    contain data. With MySQL each table contains its structure"""
+    commands = []
+    postgresql = data['drivername'].startswith('postgresql')
+    if postgresql:
+        options = snapshot and ['--snapshot=%s' % snapshot] or []
+        args, env = dump_command(data, options=options + ['-s'])
+        commands.append(('_schema', args, env))
+    for table in tables:
+        if postgresql:
+            # --clean can't be used with data only dumps
+            args, env = dump_command(data, options=options + ['-a'],
+                                     tables=[table], clean=False)
+        else:
+            args, env = dump_command(data, defaults_file,
+                                     ['--single-transaction'], [table])
+        commands.append((table, args, env))
+    return commands
+
+
+def dump_parallel(commands, directory, compressor, jobs):
+    """run ``(name, args, env)`` commands with ``jobs`` concurrent dumps.
+    Each dump goes to ``<name>.sql.<ext>`` in directory. Return the manifest
+    entries sorted by name. Raise :class:`BackupError` if a dump failed"""
+    queue = Queue.Queue()
+    for command in commands:
+        queue.put(command)
+    entries = []
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        while not errors:
+            try:
+                name, args, env = queue.get_nowait()
+            except Queue.Empty:
+                return
+            filename = os.path.join(directory,
+                                    '%s.sql%s' % (name, compressor.extension))
+            try:
+                stats = dump(args, filename, compressor, env)
+                stats['file_sha256'] = file_sha256(filename)
+            except Exception, e:
+                with lock:
+                    errors.append((name, e))
+                return
+            stats.update(name=name, file=os.path.basename(filename))
+            with lock:
+                entries.append(stats)
+
+    threads = [threading.Thread(target=work)
+               for i in range(max(1, min(jobs, len(commands))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        name, e = errors[0]
+        raise BackupError('Dump of %s failed: %s' % (name, e))
+    return sorted(entries, key=lambda e: e['name'])
+
+
+def backup_tables(data, directory, compressor, jobs=None):
+    """dump each table concurrently to a directory with a manifest.json
+    listing the sizes and checksums of the files. The directory is renamed
+    to its final name once all dumps succeeded"""
+    config = utils.user_config()
+    jobs = int(jobs or config.pytheon.backup_jobs or cpu_count())
+    # a private engine: the pools of utils.engine_from_config are shared
+    # with the rest of the process
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+    engine = create_engine(utils.get_sql_url(), poolclass=NullPool)
+    tables = list_tables(engine)
+    tmp = tempfile.mkdtemp(prefix='.%s.' % os.path.basename(directory),
+                           dir=os.path.dirname(directory))
+    defaults_file = None
+    start = time.time()
+    try:
+        if data['drivername'].startswith('mysql'):
+            defaults_file = mysql_defaults(data)
+        consistent = config.pytheon.backup_consistent
+        snapshot = Snapshot(engine, data['drivername'],
+                            not consistent or consistent.as_bool())
+        with snapshot:
+            commands = table_commands(data, tables, defaults_file,
+                                      snapshot.id)
+            entries = dump_parallel(commands, tmp, compressor, jobs)
+        manifest = dict(database=data['database'],
+                        driver=data['drivername'],
+                        created=datetime.now().isoformat(),
+                        compressor=compressor.name,
+                        consistent=snapshot.consistent,
+                        seconds=time.time() - start,
+                        tables=entries)
+        utils.atomic_write(os.path.join(tmp, 'manifest.json'),
+                           lambda fd: json.dump(manifest, fd, indent=2))
+        os.chmod(tmp, 0700)
+        os.rename(tmp, directory)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    finally:
+        if defaults_file is not None:
+            os.remove(defaults_file)
+        engine.dispose()
+    raw = sum([e['raw'] for e in entries])
+    log.info('%s: %s tables, dumped %s in %.1fs with %s jobs', directory,
+             len(tables), format_size(raw), manifest['seconds'], jobs)
+    return manifest
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 2
+
+
+def dump_to_store(args, store, name, env=None, jobs=4, **info):
+    """run the dump program ``args`` and add its output to store as the
+    backup ``name``. Only chunks which are not in store yet are written. The
+    manifest, updated with info, is saved once the dump succeeded"""
+    errors = tempfile.TemporaryFile()
+    try:
+        try:
+            dumper = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                      stderr=errors, env=env,
+                                      close_fds=True, bufsize=CHUNK_SIZE)
+        except OSError, e:
+            raise BackupError('Can not run %s: %s' % (args[0], e))
+        try:
+            manifest = store.backup(dumper.stdout, jobs)
+        finally:
+            dumper.stdout.close()
+            status = dumper.wait()
+        if status != 0:
+            errors.seek(0)
+            raise BackupError('%s exited with status %s: %s' % (
+                              args[0], status, errors.read().strip()))
+        manifest.update(info)
+        store.save(name, manifest)
+    finally:
+        store.release()
+        errors.close()
+    log.info('%s: dumped %s, wrote %s of new chunks in %.1fs (%.1fMB/s)',
+             name, format_size(manifest['size']),
+             format_size(manifest['written']), manifest['seconds'],
+             manifest['size'] / 1024. / 1024. /
+             max(manifest['seconds'], .001))
+    return manifest
+
+
+def prune_files(directory, database, **policy):
+    """remove the ``<database>-<YYYYmmddHHMM>`` backups of directory not
+    kept by the retention policy (see :func:`pytheon.store.expired`). Return
+    the removed names"""
+    names = expired(dated_backups(os.listdir(directory), database), **policy)
+    for name in names:
+        log.info('Remove backup %s', name)
+        filename = os.path.join(directory, name)
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+    return names
+
+
+def restore_command(data, defaults_file=None):
+    """return the command line and the environment of the client loading a
+    dump in the database described by data"""
+    driver = data.get('drivername') or ''
+    env = dict(os.environ)
+    if driver.startswith('mysql'):
+        args = ['mysql']
+        if defaults_file:
+            args.append('--defaults-extra-file=%s' % defaults_file)
+        args.extend(['-u', data['username'], '-h', data['host']])
+        if data.get('port'):
+            args.extend(['-P', str(data['port'])])
+        args.append(data['database'])
+    elif driver.startswith('postgresql'):
+        args = ['psql', '-q', '-w', '-v', 'ON_ERROR_STOP=1',
+                '-U', data['username'], data['database']]
+        if data.get('password'):
+            env['PGPASSWORD'] = data['password']
+    else:
+        raise BackupError('Can not restore %r databases' % driver)
+    return args, env
+
+
+def get_store(backup_dir=None):
+    """return the :class:`pytheon.store.ChunkStore` of incremental backups:
+    backup_dir, ``backup_store`` in ``~/.pytheonrc`` or ``~/backups/store``"""
+    config = utils.user_config()
+    if backup_dir or config.pytheon.backup_store:
+        directory = utils.realpath(
+                        os.path.expanduser(backup_dir or
+                                           config.pytheon.backup_store))
+    else:
+        directory = utils.realpath(os.path.expanduser('~'), 'backups',
+                                   'store')
+    level = int(config.pytheon.backup_compress_level or LEVELS['gzip'])
+    return ChunkStore(directory, level)
+
+
+def backup_db(backup_dir=None, dry_run=False, compressor=None,
+              parallel=False, jobs=None, incremental=False):
+    """dump the database to ``<database>-<YYYYmmddHHMM>.sql.<ext>`` in
+    backup_dir (default: ``~/backups/sql``). With ``parallel`` tables are
+    dumped concurrently by ``jobs`` processes in a
+    ``<database>-<YYYYmmddHHMM>`` directory (see :func:`backup_tables`).
+    With ``incremental`` the dump is added to a deduplicated store (see
+    :func:`get_store`). Old backups are then removed according to the
+    ``backup_keep_daily``, ``backup_keep_weekly`` and
+    ``backup_keep_monthly`` options of ``~/.pytheonrc``, if any. Return the
+    filename or the name of the incremental backup"""
+    data = utils.engine_dict()
+    now = datetime.now().strftime('%Y%m%d%H%M')
+    config = utils.user_config()
+    policy = retention_policy(config)
+    if incremental:
+        store = get_store(backup_dir)
+        name = '%s-%s' % (data['database'], now)
+        args, env = dump_command(data)
+        if dry_run:
+            log.info('%s > %s', ' '.join(args),
+                     store.manifest_path(name))
+            return name
+        log.info('Backuping to %s', store.manifest_path(name))
+        defaults_file = None
+        if args[0] == 'mysqldump':
+            defaults_file = mysql_defaults(data)
+            args, env = dump_command(data, defaults_file)
+        try:
+            dump_to_store(args, store, name, env,
+                          int(jobs or config.pytheon.backup_jobs or
+                              cpu_count()),
+                          database=data['database'],
+                          driver=data['drivername'],
+                          created=datetime.now().isoformat())
+        finally:
+            if defaults_file is not None:
+                os.remove(defaults_file)
+        if policy:
+            store.prune(data['database'], **policy)
+        return name
+    compressor = get_compressor(compressor)
+    if backup_dir:
+        directory = utils.realpath(backup_dir)
+    else:
+        directory = utils.realpath(os.path.expanduser('~'), 'backups', 'sql')
+    if parallel:
+        filename = os.path.join(directory, '%s-%s' % (data['database'], now))
+    else:
+        filename = os.path.join(directory, '%s-%s.sql%s' % (
+                                data['database'], now, compressor.extension))
+    args, env = dump_command(data)
+    if dry_run and parallel:
+        log.info('Dump each table with %s to %s', args[0], filename)
+        return filename
+    elif dry_run:
+        log.info('%s | %s > %s', ' '.join(args), compressor.name, filename)
+        return filename
+    log.info('Backuping to %s', filename)
+    if parallel:
+        backup_tables(data, filename, compressor, jobs)
+    else:
+        defaults_file = None
+        if args[0] == 'mysqldump':
+            defaults_file = mysql_defaults(data)
+            args, env = dump_command(data, defaults_file)
+        try:
+            dump(args, filename, compressor, env)
+        finally:
+            if defaults_file is not None:
+                os.remove(defaults_file)
+    if policy:
+        prune_files(directory, data['database'], **policy)
+    return filename
+
+
+def verify_backup(name=None, backup_dir=None, jobs=None):
+    """read all chunks of an incremental backup (default: the last one).
+    Raise :class:`BackupError` if some are missing or corrupted"""
+    store = get_store(backup_dir)
+    names = store.backups()
+    name = name or (names and names[-1])
+    if not name:
+        raise BackupError('No backup in %s' % store.directory)
+    try:
+        errors = store.verify(name, int(jobs or cpu_count()))
+    except StoreError, e:
+        raise BackupError(str(e))
+    if errors:
+        raise BackupError('%s is corrupted:\n%s' % (name, '\n'.join(errors)))
+    log.info('%s: OK', name)
+    return name
+
+
+def restore_db(name, backup_dir=None, jobs=None):
+    """load an incremental backup in the database. Chunks are read and
+    checked in parallel while the client loads the dump"""
+    data = utils.engine_dict()
+    store = get_store(backup_dir)
+    defaults_file = None
+    if (data.get('drivername') or '').startswith('mysql'):
+        defaults_file = mysql_defaults(data)
+    errors = tempfile.TemporaryFile()
+    try:
+        args, env = restore_command(data, defaults_file)
+        try:
+            client = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                      stdout=errors, stderr=errors, env=env,
+                                      close_fds=True, bufsize=CHUNK_SIZE)
+        except OSError, e:
+            raise BackupError('Can not run %s: %s' % (args[0], e))
+        try:
+            store.restore(name, client.stdin, int(jobs or cpu_count()))
+        except (StoreError, IOError), e:
+            client.stdin.close()
+            client.wait()
+            raise BackupError('Restore of %s failed: %s' % (name, e))
+        client.stdin.close()
+        status = client.wait()
+        if status != 0:
+            errors.seek(0)
+            raise BackupError('%s exited with status %s: %s' % (
+                              args[0], status, errors.read().strip()))
+    finally:
+        errors.close()
+        if defaults_file is not None:
+            os.remove(defaults_file)
+    log.info('%s restored', name)
+    return name
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import os
+import time
+import hashlib
+import logging
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from pytheon import utils
+from pytheon.compat import json
+
+log = logging.getLogger(__name__)
+
+# set to False to bypass the cache (--no-cache)
+enabled = True
+
+MAX_SIZE = 10 * 1024 * 1024
+
+
+def parse_cache_control(value):
+    """parse a Cache-Control header::
+
+        >>> sorted(parse_cache_control('private, max-age=60').items())
+        [('max-age', '60'), ('private', None)]
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        part = part.strip().lower()
+        if not part:
+            continue
+        if '=' in part:
+            k, v = part.split('=', 1)
+            directives[k.strip()] = v.strip().strip('"')
+        else:
+            directives[part] = None
+    return directives
+
+
+class Entry(object):
+    """A cached response"""
+
+    def __init__(self, path, headers, body, stored=None):
+        self.path = path
+        self.headers = dict([(k.lower(), v) for k, v in headers])
+        self.body = body
+        self.stored = stored or time.time()
+
+    @property
+    def content_type(self):
+        return self.headers.get('content-type', 'text/plain')
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(self.headers.get('cache-control'))
+
+    @property
+    def expires(self):
+        """timestamp after which the entry must be revalidated"""
+        cc = self.cache_control
+        if 'no-cache' in cc:
+            return 0
+        if cc.get('max-age'):
+            try:
+                return self.stored + int(cc['max-age'])
+            except ValueError:
+                return 0
+        if 'expires' in self.headers:
+            date = parsedate_tz(self.headers['expires'])
+            if date:
+                return mktime_tz(date)
+        return 0
+
+    def is_fresh(self):
+        return self.expires > time.time()
+
+    def is_cacheable(self):
+        if 'no-store' in self.cache_control:
+            return False
+        return bool(self.is_fresh() or 'etag' in self.headers or
+                    'last-modified' in self.headers)
+
+    def conditional_headers(self):
+        """headers used to revalidate the entry"""
+        headers = {}
+        if 'etag' in self.headers:
+            headers['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+    def revalidated(self, headers):
+        """update the entry after a 304 response"""
+        for k, v in headers:
+            if k.lower() in ('cache-control', 'expires', 'etag',
+                             'last-modified', 'date'):
+                self.headers[k.lower()] = v
+        self.stored = time.time()
+
+
+class ResponseCache(object):
+    """Store GET responses in ``directory``, one file per response. The least
+    recently used responses are removed when the total size exceeds
+    ``max_size`` bytes"""
+
+    def __init__(self, directory, max_size=MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, *args):
+        return hashlib.sha1('\n'.join([str(a) for a in args])).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fd:
+            meta = json.loads(fd.readline())
+            body = fd.read()
+        return Entry(meta['path'], meta['headers'], body, meta['stored'])
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            entry = self.read(filename)
+            # mtime is used as the LRU clock
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def store(self, key, entry):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        meta = json.dumps(dict(path=entry.path, stored=entry.stored,
+                               headers=entry.headers.items()))
+
+        def write(fd):
+            fd.write(meta + '\n')
+            fd.write(entry.body)
+
+        # responses may hold private data
+        utils.atomic_write(self.filename(key), write, 0600)
+        self.evict()
+
+    def entries(self):
+        """return a list of ``(mtime, size, filename)`` sorted by mtime"""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        size = sum([e[1] for e in entries])
+        while entries and size > self.max_size:
+            mtime, entry_size, filename = entries.pop(0)
+            self.remove(filename)
+            size -= entry_size
+
+    def invalidate(self, path):
+        """remove responses of path, of its parents and of its children,
+        whatever their query string. Used after a POST or DELETE so a listing
+        of the modified resource is not served from the cache.
+        ``/v1/applications1`` is not related to ``/v1/applications12``"""
+        path = path.split('?', 1)[0].rstrip('/')
+        for mtime, size, filename in self.entries():
+            try:
+                cached_path = self.read(filename).path
+            except (IOError, OSError, ValueError, KeyError):
+                cached_path = path
+            cached_path = cached_path.split('?', 1)[0].rstrip('/')
+            if cached_path == path or \
+               cached_path.startswith(path + '/') or \
+               path.startswith(cached_path + '/'):
+                log.debug('Invalidate cached %s', cached_path)
+                self.remove(filename)
+
+    def remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        for mtime, size, filename in self.entries():
+            self.remove(filename)
+
+
+def get_cache(config=None):
+    """return the user's ResponseCache or None if the cache is disabled with
+    ``--no-cache`` or ``cache = false`` in ``~/.pytheonrc``"""
+    config = config or utils.user_config()
+    if not enabled or (config.pytheon.cache and
+                       not config.pytheon.cache.as_bool()):
+        return None
+    directory = os.path.expanduser(
+                    config.pytheon.cache_dir or '~/.pytheon/cache')
+    return ResponseCache(directory,
+                         int(config.pytheon.cache_size or MAX_SIZE))
@@ -5,16 +5,18 @@ import os.path
 import sys
 import logging as log
 import functools
-from pytheon import http
 from pytheon import utils
+from pytheon import cache
 from pytheon.utils import Config
+from pytheon.compat import json
 from optparse import OptionParser
-# totot
+# commands are registered by name. Parsers are only built when a command is
+# used and heavy modules (http, ssl, keyring) are imported by the commands
+# themselves to keep the startup fast
 commands = []
 project_commands = []
 
 filename = os.path.expanduser('~/.pytheonrc')
-global_config = utils.user_config()
 
 
 def with_project(func):
@@ -31,20 +33,37 @@ def with_project(func):
 
 
 def with_parser(parser):
-    parser.add_option("--verbose",
-                       action="store_true", dest="verbose", default=False)
+    """register a command. ``parser`` is an OptionParser or a function
+    returning one. The later is called each time the command is used so
+    nothing is computed at import time"""
+    def add_global_options(p):
+        p.add_option("--verbose",
+                     action="store_true", dest="verbose", default=False)
+        p.add_option("--no-cache", action="store_true", dest="no_cache",
+                     default=False, help="Do not use cached API responses")
+        return p
+
+    if isinstance(parser, OptionParser):
+        add_global_options(parser)
+        get_parser = lambda: parser
+    else:
+        get_parser = lambda: add_global_options(parser())
 
     def wrapper(func):
         if getattr(func, 'project_command', False):
             project_commands.append(func.func_name)
         else:
             commands.append(func.func_name)
-        parser.usage = '%%prog %s [options]\n\n%s' % (func.func_name,
-                                                      func.__doc__.strip())
 
         @functools.wraps(func)
         def wrapped(args, **kwargs):
+            parser = get_parser()
+            parser.usage = '%%prog %s [options]\n\n%s' % (func.func_name,
+                                                          func.__doc__.strip())
             options, args = parser.parse_args(args)
+            use_cache = cache.enabled
+            if options.no_cache:
+                cache.enabled = False
             try:
                 result = func(parser, options, args, **kwargs)
             except KeyboardInterrupt:
@@ -55,30 +74,65 @@ def with_parser(parser):
                 parser.parse_args(['-h'])
             else:
                 return result
+            finally:
+                cache.enabled = use_cache
         return wrapped
     return wrapper
 
 
+def log_result(result):
+    """log a command result line by line. Lines starting with ``! `` are
+    errors. ``result`` is a string or an iterator of lines which are logged
+    as they come. Return the whole output"""
+    streamed = not isinstance(result, basestring)
+    if streamed:
+        lines = result
+    else:
+        lines = result.strip().split('\n')
+    output = []
+    for line in lines:
+        output.append(line)
+        line = line.strip()
+        if streamed and not line:
+            # streams may yield empty chunks
+            continue
+        if line.startswith('! '):
+            log.error(line[2:])
+        else:
+            log.info(line)
+    if streamed:
+        return ''.join(output)
+    return result
+
+
+def is_output(result):
+    """True if result is a string or a stream of lines"""
+    return isinstance(result, basestring) or hasattr(result, 'next')
+
+
 def commit(binary, filename):
     utils.call(binary, 'add', filename, silent=True)
     utils.call(binary, 'commit', filename, '-m',
                '"[pytheon] auto update %s"' % filename, silent=True)
 
 
-parser = OptionParser()
-parser.add_option('-e', '--email', action='store', default=utils.user(),
-                  metavar='EMAIL', dest='username',
-                  help='E-mail. Default: %s' % utils.user())
-parser.add_option('-k', '--confirm-key', action='store', default=None,
-                  dest='key', help='Confirm key')
-parser.add_option('-r', '--reset-password',
-                  action='store_true', dest='reset',
-                  help='Send a password reset request')
+def register_parser():
+    parser = OptionParser()
+    parser.add_option('-e', '--email', action='store', default=utils.user(),
+                      metavar='EMAIL', dest='username',
+                      help='E-mail. Default: %s' % utils.user())
+    parser.add_option('-k', '--confirm-key', action='store', default=None,
+                      dest='key', help='Confirm key')
+    parser.add_option('-r', '--reset-password',
+                      action='store_true', dest='reset',
+                      help='Send a password reset request')
+    return parser
 
 
-@with_parser(parser)
+@with_parser(register_parser)
 def register(parser, options, args):
     """register on pytheon"""
+    from pytheon import http
     if options.key and options.reset:
         parser.error("You can't reset a password with a confirmation key")
 
@@ -102,21 +156,24 @@ def register(parser, options, args):
         return http.request('/v1/register', auth=False, email=options.username)
 
 
-parser = OptionParser()
-parser.add_option('-b', '--buildout', action='store_true', default=False,
-                  dest='buildout',
-                  help='Use buildout.cfg file instead of deploy.ini')
-parser.add_option('-n', '--project-name', action='store',
-                  default=os.path.basename(os.getcwd()),
-                  dest='project_name', help='Specify application name')
-parser.add_option('-e', '--email', action='store', default=utils.user(),
-                  metavar='EMAIL', dest='username',
-                  help='E-mail. Default: %s' % utils.user())
+def create_parser():
+    parser = OptionParser()
+    parser.add_option('-b', '--buildout', action='store_true', default=False,
+                      dest='buildout',
+                      help='Use buildout.cfg file instead of deploy.ini')
+    parser.add_option('-n', '--project-name', action='store',
+                      default=os.path.basename(os.getcwd()),
+                      dest='project_name', help='Specify application name')
+    parser.add_option('-e', '--email', action='store', default=utils.user(),
+                      metavar='EMAIL', dest='username',
+                      help='E-mail. Default: %s' % utils.user())
+    return parser
 
 
-@with_parser(parser)
+@with_parser(create_parser)
 def create(parser, options, args):
     """create your pytheon project"""
+    from pytheon import http
     binary = utils.vcs_binary()
 
     global_config = utils.user_config()
@@ -162,45 +219,111 @@ def create(parser, options, args):
     return http.request('/v1/applications', name=config.deploy.project_name)
 
 
-parser = OptionParser()
-parser.add_option('-l', '--list', action='store_true', default=False,
-                  dest='list', help='List your application')
-parser.add_option('--delete', action='store', default=None, metavar='APP',
-                  dest='delete', help='Delete application')
-
-
-@with_parser(parser)
+def apps_parser():
+    parser = OptionParser()
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      dest='list', help='List your application')
+    parser.add_option('--addons', action='store_true', default=False,
+                      dest='addons', help='List addons of all applications')
+    parser.add_option('--delete', action='append', default=None,
+                      metavar='APP', dest='delete',
+                      help='Delete application. Can be repeated')
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      default=None, dest='jobs',
+                      help='Max number of concurrent requests')
+    add_listing_options(parser)
+    return parser
+
+
+def add_listing_options(parser):
+    parser.add_option('--limit', action='store', type='int', default=None,
+                      dest='limit', help='Max number of listed items')
+    parser.add_option('--fields', action='store', default=None,
+                      metavar='FIELD,...', dest='fields',
+                      help='Only show these fields, tab separated')
+
+
+def listing(path, options):
+    """iter on a paginated listing according to ``--limit`` and
+    ``--fields``"""
+    from pytheon import http
+    if not options.fields:
+        return http.iter_listing(path, limit=options.limit)
+    fields = [f.strip() for f in options.fields.split(',') if f.strip()]
+    items = http.iter_listing(path, limit=options.limit, fields=fields,
+                              json=True)
+    return (format_fields(item, fields) for item in items)
+
+
+def format_fields(item, fields):
+    """format fields of a JSON item as a tab separated line"""
+    values = []
+    for field in fields:
+        value = None
+        if isinstance(item, utils.JSONView):
+            value = item.get(field)
+        if isinstance(value, utils.JSONList):
+            value = ','.join([unicode(v) for v in value])
+        if value is None:
+            value = '-'
+        values.append(unicode(value))
+    return '\t'.join(values) + '\n'
+
+
+@with_parser(apps_parser)
 def apps(parser, options, args):
     """Application related command"""
+    from pytheon import http
 
     if options.delete:
-        return http.request('/v1/applications/%s' % options.delete,
-                            method='DELETE')
-    return http.request('/v1/applications')
-
-parser = OptionParser()
-parser.add_option('-l', '--list', action='store_true', default=False,
-                  dest='list', help='List your application addons')
-parser.add_option('--add', action='store', default=None,
-                  metavar='ADDON:PLAN',
-                  dest='add', help='Add application addon')
-parser.add_option('--upgrade', action='store', default=None,
-                  metavar='ADDON:PLAN',
-                  dest='upgrade', help='Upgrade application addon')
-parser.add_option('--delete', action='store', default=None, metavar='ADDON',
-                  dest='delete', help='Delete application addon')
-parser.add_option('--all', action='store_true', default=False,
-                  dest='all', help='List all available addons')
-
-
-@with_parser(parser)
+        paths = ['/v1/applications/%s' % name for name in options.delete]
+        results = http.request_many([(p, 'DELETE') for p in paths],
+                                    concurrency=options.jobs)
+        return '\n'.join(results)
+    if not options.addons:
+        return listing('/v1/applications', options)
+    names = [app.name for app in
+             http.iter_listing('/v1/applications', limit=options.limit,
+                               fields=['name'], json=True)
+             if isinstance(app, utils.JSONView) and app.name]
+    results = http.request_many(
+            ['/v1/applications/%s/addons' % name for name in names],
+            concurrency=options.jobs)
+    output = []
+    for name, addons in zip(names, results):
+        output.append('[%s]' % name)
+        output.append(addons.strip())
+    return '\n'.join(output)
+
+
+def addons_parser():
+    parser = OptionParser()
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      dest='list', help='List your application addons')
+    parser.add_option('--add', action='store', default=None,
+                      metavar='ADDON:PLAN',
+                      dest='add', help='Add application addon')
+    parser.add_option('--upgrade', action='store', default=None,
+                      metavar='ADDON:PLAN',
+                      dest='upgrade', help='Upgrade application addon')
+    parser.add_option('--delete', action='store', default=None,
+                      metavar='ADDON', dest='delete',
+                      help='Delete application addon')
+    parser.add_option('--all', action='store_true', default=False,
+                      dest='all', help='List all available addons')
+    add_listing_options(parser)
+    return parser
+
+
+@with_parser(addons_parser)
 @with_project
 def addons(parser, options, args, config):
     """Addon management"""
+    from pytheon import http
 
     path = '/v1/applications/%s/addons' % config.deploy.project_name
     if options.all:
-        return http.request('/v1/addons')
+        return listing('/v1/addons', options)
     elif options.add:
         try:
             id, plan = options.add.split(':')
@@ -217,13 +340,15 @@ def addons(parser, options, args, config):
         return http.request('%s/%s' % (path, options.delete),
                             method='DELETE')  # FIXME
     else:
-        return http.request(path)
+        return listing(path, options)
 
 
-parser = OptionParser()
+def deploy_parser():
+    parser = OptionParser()
+    return parser
 
 
-@with_parser(parser)
+@with_parser(deploy_parser)
 @with_project
 def deploy(parser, options, args, config):
     """Deploy current repository to pytheon"""
@@ -249,30 +374,35 @@ def deploy(parser, options, args, config):
     log.info('Deploy success')
 
 
-parser = OptionParser()
-parser.add_option('-e', '--email', action='store', default=utils.user(),
-                  metavar='EMAIL', dest='username',
-                  help='E-mail. Default: %s' % utils.user())
-parser.add_option('-v', '--version', action='store', default=None,
-                  dest='version',
-                  help='open a shell for the versioned application')
+def shell_parser():
+    parser = OptionParser()
+    parser.add_option('-e', '--email', action='store', default=utils.user(),
+                      metavar='EMAIL', dest='username',
+                      help='E-mail. Default: %s' % utils.user())
+    parser.add_option('-v', '--version', action='store', default=None,
+                      dest='version',
+                      help='open a shell for the versioned application')
+    return parser
 
 
-@with_parser(parser)
+@with_parser(shell_parser)
 @with_project
 def shell(parser, options, args, config):
     """Open a ssh shell on pytheon"""
+    global_config = utils.user_config()
     kw = dict(project_name=global_config.pytheon.project_name)
     utils.call('ssh', '%(project_name)s@pytheon.net' % kw)
 
-parser = OptionParser()
-parser.add_option('-e', '--enable', action='store_true', default=False,
-                  dest='enable', help='disable maintenance page')
-parser.add_option('-d', '--disable', action='store_true', default=False,
-                  dest='disable', help='disable maintenance page')
+def maintenance_parser():
+    parser = OptionParser()
+    parser.add_option('-e', '--enable', action='store_true', default=False,
+                      dest='enable', help='disable maintenance page')
+    parser.add_option('-d', '--disable', action='store_true', default=False,
+                      dest='disable', help='disable maintenance page')
+    return parser
 
 
-@with_parser(parser)
+@with_parser(maintenance_parser)
 @with_project
 def maintenance(parser, options, args):
     """toggle maintenance page"""
@@ -283,14 +413,17 @@ def maintenance(parser, options, args):
     else:
         parser.parse_args(['-h'])
 
-parser = OptionParser()
-parser.add_option('-n', '--name', action='store',
-                  dest='name', help='Specify key name')
+def add_key_parser():
+    parser = OptionParser()
+    parser.add_option('-n', '--name', action='store',
+                      dest='name', help='Specify key name')
+    return parser
 
 
-@with_parser(parser)
+@with_parser(add_key_parser)
 def add_key(parser, options, args):
     """Add a public key to pytheon account"""
+    from pytheon import http
     if args:
         filename = args[0]
         filename = os.path.expandvars(os.path.expanduser(filename))
@@ -319,3 +452,124 @@ def add_key(parser, options, args):
     if options.name:
         params.update(dict(name=options.name))
     return http.request('/v1/account/keys', **params)
+
+
+def batch_parser():
+    parser = OptionParser()
+    parser.add_option('-k', '--keep-going', action='store_true',
+                      default=False, dest='keep_going',
+                      help='Continue after a failed command')
+    return parser
+
+
+def parse_batch(fd):
+    """yield commands from fd. A command is a shell like line
+    (``create -n myapp``) or a JSON list (``["create", "-n", "myapp"]``) or
+    object (``{"command": "create", "args": ["-n", "myapp"]}``). Blank lines
+    and lines starting with ``#`` are ignored"""
+    import shlex
+    for line in fd:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line[0] in '[{':
+            args = json.loads(line)
+            if isinstance(args, dict):
+                args = [args['command']] + list(args.get('args', []))
+            args = [str(a) for a in args]
+        else:
+            args = shlex.split(line)
+        if args and args[0] == 'pytheon':
+            args = args[1:]
+        if args:
+            yield args
+
+
+@with_parser(batch_parser)
+def batch(parser, options, args, **kwargs):
+    """run commands read from a file (or - for stdin) in a single process.
+One command per line, eg: 'addons --add mysql:basic'. HTTP connections
+and credentials are shared by all commands"""
+    import time
+    if len(args) != 1:
+        parser.error('Please specify a file or -')
+    if args[0] == '-':
+        fd = sys.stdin
+    else:
+        fd = open(args[0])
+
+    available = commands + project_commands
+    results = []
+    start = time.time()
+    for cmd_args in parse_batch(fd):
+        log.info('$ pytheon %s', ' '.join(cmd_args))
+        name, cmd_args = cmd_args[0], cmd_args[1:]
+        cmd_start = time.time()
+        status = 'ok'
+        if name == 'batch' or name not in available:
+            log.error('Invalid command: %s', name)
+            status = 'error'
+        else:
+            try:
+                result = globals()[name](cmd_args, **kwargs)
+            except SystemExit:
+                status = 'error'
+            else:
+                if is_output(result):
+                    result = log_result(result)
+                    if [l for l in result.split('\n')
+                            if l.strip().startswith('! ')]:
+                        status = 'error'
+        duration = time.time() - cmd_start
+        results.append((name, status, duration))
+        log.info('[%s] %s (%.3fs)', status, name, duration)
+        if status != 'ok' and not options.keep_going:
+            break
+
+    if fd is not sys.stdin:
+        fd.close()
+    failed = len([r for r in results if r[1] != 'ok'])
+    log.info('%s commands, %s failed in %.3fs',
+             len(results), failed, time.time() - start)
+    if failed:
+        sys.exit(1)
+
+
+def agent_parser():
+    parser = OptionParser()
+    parser.add_option('-f', '--foreground', action='store_true',
+                      default=False, dest='foreground',
+                      help='Do not run in the background')
+    parser.add_option('--stop', action='store_true', default=False,
+                      dest='stop', help='Stop the running agent')
+    parser.add_option('--status', action='store_true', default=False,
+                      dest='status', help='Show if an agent is running')
+    parser.add_option('-s', '--socket', action='store', default=None,
+                      metavar='PATH', dest='socket',
+                      help='UNIX socket (default: $PYTHEON_AGENT_SOCK or '
+                           '~/.pytheon/agent.sock)')
+    parser.add_option('--idle-timeout', action='store', type='int',
+                      default=None, dest='idle_timeout',
+                      help='Exit after this many seconds without command')
+    return parser
+
+
+@with_parser(agent_parser)
+def agent(parser, options, args):
+    """Run a local agent keeping config, credentials and connections in
+    memory. Next commands are forwarded to it"""
+    import pytheon.agent
+    path = options.socket or pytheon.agent.socket_path()
+    if options.stop:
+        return pytheon.agent.stop(path)
+    elif options.status:
+        pid = pytheon.agent.ping(path)
+        if pid:
+            return 'Agent running on %s (pid %s)' % (path, pid)
+        return 'No agent running'
+    config = utils.user_config()
+    idle_timeout = options.idle_timeout or \
+                   int(config.pytheon.agent_idle_timeout or
+                       pytheon.agent.IDLE_TIMEOUT)
+    return pytheon.agent.start(path, foreground=options.foreground,
+                               idle_timeout=idle_timeout)
@@ -1,14 +1,29 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
 import logging
 import httplib
 import ssl
+import re
 import sys
+import errno
+import time
 import base64
 import socket
+import select
 import os.path
+import threading
+import Queue
+import zlib
+import random
 from urllib import urlencode
+from urlparse import parse_qsl
 from Cookie import SimpleCookie
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
 from pytheon import utils
+from pytheon import cache
+from pytheon import trace
+from pytheon.compat import json as jsonlib
 from pytheon.ssl_match_hostname import match_hostname
 
 log = logging.getLogger(__name__)
@@ -21,21 +36,72 @@ except ImportError:
 
 ca_certs = utils.join(os.path.dirname(__file__), 'pytheon.pem')
 
+ssl_lock = threading.Lock()
+ssl_contexts = {}
+ssl_sessions = {}
+ssl_stats = dict(handshakes=0, resumed=0)
+
+
+def ssl_context(ca_certs=ca_certs, ssl_version=ssl.PROTOCOL_SSLv23):
+    """Return a process wide :class:`ssl.SSLContext` for ``ca_certs``. The CA
+    file is only parsed once. SSLv2, SSLv3 and TLSv1.0/1.1 are disabled.
+    Return None if the ssl module does not support contexts"""
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    key = (ca_certs, ssl_version)
+    with ssl_lock:
+        context = ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl_version)
+            for name in ('OP_NO_SSLv2', 'OP_NO_SSLv3',
+                         'OP_NO_TLSv1', 'OP_NO_TLSv1_1'):
+                context.options |= getattr(ssl, name, 0)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(ca_certs)
+            ssl_contexts[key] = context
+    return context
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """like :func:`socket.create_connection` but name resolution and TCP
+    connection are traced separately"""
+    host, port = address
+    with trace.span('dns', host=host):
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    error = socket.error('getaddrinfo returns an empty list')
+    with trace.span('tcp', host=host):
+        for af, socktype, proto, canonname, sa in addresses:
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                sock.connect(sa)
+                return sock
+            except socket.error, e:
+                error = e
+                if sock is not None:
+                    sock.close()
+    raise error
+
 
 class HTTPSConnection(httplib.HTTPSConnection):
     """HTTPSConnection that performs certficate validation :
        - Checks that the server certficate was signed by one of
          the authorities whose certfication
        - Checks that the server hostname is the same as the certificate
-         common name it provided"""
+         common name it provided
+
+       Connections share a cached SSLContext and resume the last TLS session
+       of the host when the ssl module supports it. See ``ssl_stats``"""
     def __init__(self, host, ca_certs, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
-                 ssl_version=ssl.PROTOCOL_SSLv3):
+                 ssl_version=ssl.PROTOCOL_SSLv23):
         """Constructor.
            Args :
             ca_certs: Path to the file which contains concatenated certificates
                       of the authorities your trust in PEM format.
            ssl_version: SSL protocol version you want to support.
-                        Defaults to TLSv1 only."""
+                        Defaults to negotiate the best TLS version."""
         httplib.HTTPSConnection.__init__(self, host, port=443, timeout=timeout)
         self.ca_certs = ca_certs
         self.ssl_version = ssl_version
@@ -48,10 +114,81 @@ class HTTPSConnection(httplib.HTTPSConnection):
             Raises CertificateError if the server hostname does not match
                 the certificate common name.
         """
-        sock = socket.create_connection((self.host, self.port), self.timeout)
-        self.sock = ssl.wrap_socket(sock, ssl_version=self.ssl_version,
-            cert_reqs=ssl.CERT_REQUIRED, ca_certs=self.ca_certs)
+        sock = create_connection((self.host, self.port), self.timeout)
+        context = ssl_context(self.ca_certs, self.ssl_version)
+        with trace.span('tls', host=self.host):
+            if context is None:
+                self.sock = ssl.wrap_socket(sock,
+                    ssl_version=self.ssl_version,
+                    cert_reqs=ssl.CERT_REQUIRED, ca_certs=self.ca_certs)
+            else:
+                kwargs = dict(server_hostname=self.host)
+                session = ssl_sessions.get(self.host)
+                if session is not None:
+                    kwargs['session'] = session
+                self.sock = context.wrap_socket(sock, **kwargs)
+        with ssl_lock:
+            ssl_stats['handshakes'] += 1
+            if getattr(self.sock, 'session_reused', False):
+                ssl_stats['resumed'] += 1
+                log.debug('TLS session resumed for %s', self.host)
         match_hostname(self.sock.getpeercert(), self.host)
+        self.save_session()
+
+    def save_session(self):
+        # sessions are only exposed by python >= 3.6
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            ssl_sessions[self.host] = session
+
+    def close(self):
+        # TLS 1.3 tickets are received after the handshake. Save the session
+        # again before closing
+        if self.sock is not None:
+            self.save_session()
+        httplib.HTTPSConnection.close(self)
+
+
+auth_lock = threading.RLock()
+
+
+# a session cookie expiring in less than COOKIE_MARGIN seconds is not used
+COOKIE_MARGIN = 60
+# a session cookie expiring in less than REFRESH_WINDOW seconds is refreshed
+# in the background
+REFRESH_WINDOW = 300
+
+
+class Credentials(object):
+    """Process wide cache of passwords and cookies stored in the keyring.
+    Each value is read once and only written back when it changes"""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, service, username):
+        key = (service, username)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = keyring.get_password(service, username)
+            return self.values[key]
+
+    def set(self, service, username, value):
+        """store value. Return True if it changed"""
+        key = (service, username)
+        with self.lock:
+            if key in self.values and self.values[key] == value:
+                return False
+            keyring.set_password(service, username, value)
+            self.values[key] = value
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+credentials = Credentials()
 
 
 def auth_basic(retry=False):
@@ -60,116 +197,1284 @@ def auth_basic(retry=False):
     password = None
     if keyring:
         log.debug('Use keyring module. Great!')
-        password = keyring.get_password('basic:api.pytheon.net', username)
+        password = credentials.get('basic:api.pytheon.net', username)
     if password == None or retry:
         password = utils.get_input('Password', password=True)
     if keyring:
-        keyring.set_password('basic:api.pytheon.net', username, password)
+        credentials.set('basic:api.pytheon.net', username, password)
+    return basic_header(username, password)
+
+
+def basic_header(username, password):
     auth = base64.encodestring('%s:%s' % (username, password))
     return {'Authorization': 'Basic ' + auth.strip()}
 
 
+def cookie_expires(morsel):
+    """return the expiration timestamp of a cookie or None"""
+    if morsel['max-age']:
+        try:
+            return time.time() + int(morsel['max-age'])
+        except ValueError:
+            pass
+    if morsel['expires']:
+        date = parsedate_tz(morsel['expires'])
+        if date:
+            return mktime_tz(date)
+    return None
+
+
+def cookie_expired(config, margin=COOKIE_MARGIN):
+    """True if the stored session cookie expires in less than margin
+    seconds"""
+    expires = config.pytheon.auth_cookie_expires
+    return bool(expires) and float(expires) < time.time() + margin
+
+
 def auth_cookie():
     config = utils.user_config()
     if keyring:
         log.debug('Use keyring module. Great!')
-        cookie = keyring.get_password('cookie:api.pytheon.net',
-                                      config.pytheon.username)
+        cookie = credentials.get('cookie:api.pytheon.net',
+                                 config.pytheon.username)
     else:
-        config = utils.user_config()
         cookie = config.pytheon.auth_cookie or None
+    if cookie is not None and cookie_expired(config):
+        log.debug('Session is expired')
+        return None
     if cookie is not None:
+        if cookie_expired(config, REFRESH_WINDOW):
+            schedule_refresh()
         return {'Cookie': 'auth_tkt=%s' % cookie}
     return None
 
 
+refresh_lock = threading.Lock()
+
+
+def refresh_session():
+    """get a new session cookie with basic auth before the current one
+    expires. Only possible when the password is in the keyring. The request
+    is a GET on ``refresh_path`` (default: /v1/addons). Return True on
+    success"""
+    config = utils.user_config()
+    username = config.pytheon.username
+    if not keyring or not username:
+        return False
+    password = credentials.get('basic:api.pytheon.net', username)
+    if password is None:
+        return False
+    headers = basic_header(username, password)
+    headers['Accept'] = 'text/plain'
+    host = config.pytheon.api_host or 'api.pytheon.net:443'
+    path = config.pytheon.refresh_path or '/v1/addons'
+    log.debug('Refreshing session')
+    conn, resp = send_with_retry(host, 'GET', path, None, headers)
+    resp.read()
+    release(host, conn, resp)
+    if resp.status != 200:
+        return False
+    save_cookie(resp.getheaders())
+    return True
+
+
+def schedule_refresh():
+    """run :func:`refresh_session` in a background thread unless a refresh
+    is already running"""
+    if not refresh_lock.acquire(False):
+        return
+
+    def refresh():
+        try:
+            refresh_session()
+        except Exception:
+            log.debug('Unable to refresh session', exc_info=True)
+        finally:
+            refresh_lock.release()
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
 def save_cookie(headers):
     config = utils.user_config()
-    for k, v in headers:
-        if k.lower() == 'set-cookie':
-            cookie = SimpleCookie(v)
-            auth_cookie = cookie['auth_tkt'].value
-            log.debug('Cookie: %s', auth_cookie)
-            if keyring:
-                keyring.set_password('cookie:api.pytheon.net',
-                                     config.pytheon.username, auth_cookie)
+    # the session may be refreshed by a background thread
+    with utils.write_lock:
+        for k, v in headers:
+            if k.lower() == 'set-cookie':
+                cookie = SimpleCookie(v)
+                if 'auth_tkt' not in cookie:
+                    continue
+                auth_cookie = cookie['auth_tkt'].value
+                expires = cookie_expires(cookie['auth_tkt'])
+                log.debug('Cookie: %s', auth_cookie)
+                if keyring:
+                    changed = credentials.set('cookie:api.pytheon.net',
+                                              config.pytheon.username,
+                                              auth_cookie)
+                else:
+                    changed = config.pytheon.auth_cookie != auth_cookie
+                    config.pytheon.auth_cookie = auth_cookie
+                previous = float(config.pytheon.auth_cookie_expires or 0)
+                if expires and abs(expires - previous) > COOKIE_MARGIN:
+                    config.pytheon.auth_cookie_expires = '%d' % expires
+                    changed = True
+                elif not expires and previous:
+                    del config.pytheon.auth_cookie_expires
+                    changed = True
+                if changed:
+                    config.write()
+
+
+def new_connection(host):
+    host, port = host.split(':')
+    port = int(port)
+    if port == 443:
+        ## This HTTPSConnection *REQUIRES* a file containing concatenated
+        ## PEM certificates of the authorities you trust. This means you
+        ## *HAVE TO* bundle certificates with your application
+        ## (as firefox does).
+        ##
+        ## If you are running on a debian/ubuntu system,
+        ## mozilla certificates are located in
+        ## /usr/share/ca-certificates/mozilla/ .You can concatenate
+        ## them with the command :
+        ## for cert in /usr/share/ca-certificates/mozilla/*crt; \
+        ##      do cat $cert >> mozcerts.pem; done
+        ##
+        ## You may want to bundle *only* your server certificate/your ca
+        ## certificate with your application to make it more secure.
+        conn = HTTPSConnection(host, ca_certs)
+    else:
+        conn = httplib.HTTPConnection(host, port)
+    return conn
+
+
+class ConnectionPool(object):
+    """Keep HTTP/1.1 connections alive between requests. Idle connections
+    are stored per host:port and reused by :func:`request`.
+
+    ``size`` is the max number of idle connections kept for a host and
+    ``idle_timeout`` the number of seconds after which an idle connection is
+    considered stale. Both can be set in the ``[pytheon]`` section of
+    ``~/.pytheonrc`` with ``pool_size`` and ``pool_idle_timeout``."""
+
+    size = 4
+    idle_timeout = 60
+
+    def __init__(self, size=None, idle_timeout=None):
+        if size is None:
+            size = self.__class__.size
+        if idle_timeout is None:
+            idle_timeout = self.__class__.idle_timeout
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        """read pool settings from a user config"""
+        self.size = int(config.pytheon.pool_size or self.__class__.size)
+        self.idle_timeout = float(config.pytheon.pool_idle_timeout or
+                                  self.__class__.idle_timeout)
+
+    def is_stale(self, conn, last_used):
+        if time.time() - last_used > self.idle_timeout:
+            return True
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            # an idle keep-alive socket must not be readable. If it is then
+            # the server closed it (or sent garbage)
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def get(self, host):
+        """return a ``(connection, reused)`` tuple for host"""
+        with self.lock:
+            idle = self.connections.get(host, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if self.is_stale(conn, last_used):
+                    log.debug('Drop stale connection to %s', host)
+                    close(conn)
+                    continue
+                log.debug('Reuse connection to %s', host)
+                return conn, True
+        return new_connection(host), False
+
+    def put(self, host, conn):
+        """release a connection. The response must be fully read"""
+        with self.lock:
+            idle = self.connections.setdefault(host, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        close(conn)
+
+    def clear(self):
+        """close all idle connections"""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for idle in connections.values():
+            for conn, last_used in idle:
+                close(conn)
+
+pool = ConnectionPool()
+
+
+def close(conn):
+    if hasattr(conn, 'close'):
+        conn.close()
+
+
+def set_timeout(conn, timeout=None):
+    """set the socket timeout of a (pooled) connection. None means the
+    default socket timeout"""
+    if timeout is None:
+        conn.timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        timeout = socket.getdefaulttimeout()
+    else:
+        conn.timeout = timeout
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+class StaleConnection(socket.error):
+    """The server reset the connection while the request was sent"""
+
+
+def closed_by_server(error):
+    """return True if error means that the server closed a connection before
+    it read the request: no byte of a response was received so the request
+    can be sent again. Timeouts and invalid responses are not"""
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ('', "''") or \
+               error.line.startswith('No status line')
+    return isinstance(error, (StaleConnection, httplib.CannotSendRequest))
+
+
+def send_data(func, *args):
+    """call a function sending data on a connection. Raise
+    :class:`StaleConnection` if the server reset the connection"""
+    try:
+        return func(*args)
+    except socket.error, e:
+        if e.errno in (errno.ECONNRESET, errno.EPIPE):
+            raise StaleConnection(e.errno, e.strerror)
+        raise
+
+
+def send(host, method, path, params, headers, timeout=None, expect=False):
+    """send a request on a pooled connection. If a reused connection was
+    closed by the server then retry once on a fresh connection. Return a
+    ``(connection, response)`` tuple"""
+    conn, reused = pool.get(host)
+    set_timeout(conn, timeout)
+    try:
+        return conn, exchange(conn, method, path, params, headers, expect)
+    except (socket.error, httplib.BadStatusLine, httplib.CannotSendRequest), e:
+        close(conn)
+        if not reused or not closed_by_server(e):
+            raise
+    log.debug('Connection to %s was closed. Reconnecting', host)
+    conn = new_connection(host)
+    set_timeout(conn, timeout)
+    return conn, exchange(conn, method, path, params, headers, expect)
+
+
+def exchange(conn, method, path, params, headers, expect=False):
+    """send a request and wait for the response headers. With ``expect``
+    large bodies are only sent once the server accepted the headers"""
+    if getattr(conn, 'sock', False) is None:
+        # open the socket ourself so connection steps are traced
+        if isinstance(conn, HTTPSConnection):
+            conn.connect()
+        else:
+            conn.sock = create_connection((conn.host, conn.port),
+                                          conn.timeout)
+    if expect and params is not None and len(params) > EXPECT_MIN_SIZE and \
+       getattr(conn, 'sock', None) is not None and \
+       '%s:%s' % (conn.host, conn.port) not in no_continue:
+        return exchange_expect_continue(conn, method, path, params, headers)
+    with trace.span('send'):
+        send_data(conn.request, method, path, params, headers)
+    with trace.span('ttfb'):
+        return conn.getresponse()
+
+
+# bodies larger than EXPECT_MIN_SIZE are sent with Expect: 100-continue when
+# the request may be rejected
+EXPECT_MIN_SIZE = 1024
+# seconds to wait for 100 Continue before sending the body anyway
+EXPECT_TIMEOUT = 1.
+# hosts which did not answer 100 Continue. They get the body right away
+no_continue = set()
+
+
+class BufferedSocket(object):
+    """Give back bytes already read from a socket to
+    :class:`httplib.HTTPResponse`"""
+
+    def __init__(self, sock, data):
+        self.sock = sock
+        self.data = data
+
+    def makefile(self, mode='rb', bufsize=0):
+        return BufferedFile(self.sock.makefile(mode, bufsize), self.data)
+
+
+class BufferedFile(object):
+
+    def __init__(self, fp, data):
+        self.fp = fp
+        self.data = data
+
+    def read(self, amt=None):
+        data, self.data = self.data, ''
+        if amt is None:
+            return data + self.fp.read()
+        if len(data) >= amt:
+            self.data = data[amt:]
+            return data[:amt]
+        return data + self.fp.read(amt - len(data))
+
+    def readline(self, limit=-1):
+        if '\n' in self.data:
+            line, self.data = self.data.split('\n', 1)
+            return line + '\n'
+        data, self.data = self.data, ''
+        return data + self.fp.readline(limit)
+
+    def close(self):
+        self.fp.close()
+
+
+def read_status_line(sock):
+    line = ''
+    while not line.endswith('\n') and len(line) < 65536:
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line
+
+
+def exchange_expect_continue(conn, method, path, body, headers):
+    """send headers with ``Expect: 100-continue`` and only send the body
+    once the server accepted it. If the server answers with a final status
+    (e.g. 401) the body is never sent and the connection will be closed"""
+    headers = dict(headers, Expect='100-continue')
+    headers['Content-Length'] = str(len(body))
+    names = [k.lower() for k in headers]
+    skips = {}
+    if 'host' in names:
+        skips['skip_host'] = 1
+    if 'accept-encoding' in names:
+        skips['skip_accept_encoding'] = 1
+    sock = conn.sock
+    with trace.span('send'):
+        conn.putrequest(method, path, **skips)
+        for k, v in headers.items():
+            conn.putheader(k, v)
+        send_data(conn.endheaders)
+        pending = getattr(sock, 'pending', lambda: 0)()
+        if not pending and \
+           not select.select([sock], [], [], EXPECT_TIMEOUT)[0]:
+            log.debug('%s:%s does not support 100-continue', conn.host,
+                      conn.port)
+            no_continue.add('%s:%s' % (conn.host, conn.port))
+        else:
+            line = read_status_line(sock)
+            if line.split(None, 2)[1:2] != ['100']:
+                log.debug('Body not sent: %s', line.strip())
+                resp = conn.response_class(BufferedSocket(sock, line),
+                                           strict=conn.strict,
+                                           method=method)
+                resp.begin()
+                resp.will_close = True
+                return resp
+            # skip the headers of the 100 Continue response
+            while read_status_line(sock) not in ('\r\n', '\n', ''):
+                pass
+        send_data(conn.send, body)
+    with trace.span('ttfb'):
+        return conn.getresponse()
+
+
+class CircuitOpenError(OSError):
+    """The host failed too many times. Requests fail fast until the breaker
+    timeout expires"""
+
+
+class RetryPolicy(object):
+    """Retry failed requests with an exponential backoff and full jitter.
+    ``Retry-After`` headers are honoured. Settings can be set in the
+    ``[pytheon]`` section of ``~/.pytheonrc`` with ``retries``,
+    ``retry_backoff`` and ``retry_max_delay``"""
+
+    retries = 3
+    backoff = .5
+    max_delay = 30.
+    statuses = (429, 500, 502, 503, 504)
+    idempotent = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def configure(self, config):
+        cls = self.__class__
+        self.retries = int(config.pytheon.retries or cls.retries)
+        self.backoff = float(config.pytheon.retry_backoff or cls.backoff)
+        self.max_delay = float(config.pytheon.retry_max_delay or
+                               cls.max_delay)
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.backoff * 2 ** attempt,
+                                     self.max_delay))
+
+    def retry_after(self, value):
+        """parse a Retry-After header (seconds or HTTP date)"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            date = parsedate_tz(value)
+            if date:
+                return max(mktime_tz(date) - time.time(), 0)
+        return None
+
+retry_policy = RetryPolicy()
+
+
+class CircuitBreaker(object):
+    """Count consecutive failures per host. After ``threshold`` failures the
+    circuit is open and requests fail fast for ``reset_timeout`` seconds.
+    Then one request is allowed to test the host. Settings can be set in
+    ``~/.pytheonrc`` with ``breaker_threshold`` and
+    ``breaker_reset_timeout``"""
+
+    threshold = 5
+    reset_timeout = 30.
+
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def configure(self, config):
+        cls = self.__class__
+        self.threshold = int(config.pytheon.breaker_threshold or
+                             cls.threshold)
+        self.reset_timeout = float(config.pytheon.breaker_reset_timeout or
+                                   cls.reset_timeout)
+
+    def allow(self, host):
+        with self.lock:
+            failures, opened = self.hosts.get(host, (0, None))
+            if opened is None:
+                return True
+            if time.time() - opened >= self.reset_timeout:
+                # half open: let one request test the host
+                self.hosts[host] = (failures, time.time())
+                return True
+            return False
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            failures, opened = self.hosts.get(host, (0, None))
+            failures += 1
+            if failures >= self.threshold:
+                if opened is None:
+                    log.error('%s is not responding. Giving up for %ss',
+                              host, self.reset_timeout)
+                opened = time.time()
+            self.hosts[host] = (failures, opened)
+
+breaker = CircuitBreaker()
+
+
+def send_with_retry(host, method, path, params, headers, timeout=None,
+                    retry=None, expect=False):
+    """:func:`send` a request. Retry on network errors and on 429/5xx
+    responses according to ``retry_policy``. ``retry`` default to True for
+    idempotent methods only"""
+    if retry is None:
+        retry = method in retry_policy.idempotent
+    retries = retry and retry_policy.retries or 0
+    attempt = 0
+    while True:
+        if not breaker.allow(host):
+            raise CircuitOpenError('Unable to contact %s. Too many errors'
+                                   % host)
+        try:
+            conn, resp = send(host, method, path, params, headers, timeout,
+                              expect)
+        except socket.error, e:
+            breaker.failure(host)
+            if attempt >= retries:
+                raise OSError('Unable to contact %s: %s' % (host, e))
+            delay = retry_policy.delay(attempt)
+            log.info('Unable to contact %s: %s', host, e)
+        else:
+            if resp.status >= 500:
+                breaker.failure(host)
             else:
-                config.pytheon.auth_cookie = auth_cookie
-                config.write()
+                breaker.success(host)
+            if attempt >= retries or resp.status not in retry_policy.statuses:
+                return conn, resp
+            delay = retry_policy.delay(attempt, retry_policy.retry_after(
+                                    resp.getheader('Retry-After', None)))
+            log.info('%d - %s', resp.status, resp.reason)
+            resp.read()
+            release(host, conn, resp)
+        log.info('Retrying %s %s in %.1fs', method, path, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def release(host, conn, resp):
+    if getattr(resp, 'will_close', False):
+        close(conn)
+    else:
+        pool.put(host, conn)
 
 
-def request(path, method='GET', auth=True, host=None, json=False, **params):
+@trace.traced('request')
+def request(path, method='GET', auth=True, host=None, json=False,
+            timeout=None, use_cache=True, compress=None, stream=False,
+            retry=None, with_headers=False, **params):
+    """Send a request to the API and return the decoded body.
+    ``stream=True`` returns an iterator of lines, ``stream='chunks'`` an
+    iterator of body chunks. ``with_headers=True`` returns a ``(headers,
+    body)`` tuple. Other keyword arguments are POSTed"""
     config = utils.user_config()
+    pool.configure(config)
+    retry_policy.configure(config)
+    breaker.configure(config)
     headers = {}
+    timeout = timeout or float(config.pytheon.timeout or 0) or None
 
     if params:
         method = 'POST'
         params = urlencode(params)
         headers['Content-Type'] = "application/x-www-form-urlencoded"
+        if compress is None:
+            compress = config.pytheon.compress_requests.as_bool()
+        if compress and len(params) > COMPRESS_MIN_SIZE:
+            params = gzip_body(params)
+            headers['Content-Encoding'] = 'gzip'
     else:
         params = None
+    headers['Accept-Encoding'] = 'gzip, deflate'
 
     if json:
         headers['Accept'] = 'application/json'
     else:
         headers['Accept'] = 'text/plain'
 
+    host = host or config.pytheon.api_host or 'api.pytheon.net:443'
+    trace.annotate(method=method, path=path, host=host)
+
+    responses = use_cache and cache.get_cache(config) or None
+    cached = None
+    if responses is not None and method == 'GET':
+        cache_key = responses.key(host, path, headers['Accept'],
+                                  auth and config.pytheon.username)
+        cached = responses.get(cache_key)
+        if cached is not None:
+            if cached.is_fresh():
+                log.debug('Use cached response for %s', path)
+                if stream:
+                    body = cached_stream(cached.content_type, cached.body,
+                                         stream)
+                else:
+                    body = decode(cached.content_type, cached.body)
+                if with_headers:
+                    return cached.headers.items(), body
+                return body
+            headers.update(cached.conditional_headers())
+
+    cookie_auth = None
+    expect = False
     if auth:
-        cookie_auth = auth_cookie()
-        if cookie_auth is not None:
-            log.debug('Use cookie: %s' % cookie_auth)
-            headers.update(cookie_auth)
-        else:
-            log.debug('Use auth basic')
-            headers.update(auth_basic())
-
-    def get_conn(host):
-        host, port = host.split(':')
-        port = int(port)
-        if port == 443:
-            ## This HTTPSConnection *REQUIRES* a file containing concatenated
-            ## PEM certificates of the authorities you trust. This means you
-            ## *HAVE TO* bundle certificates with your application
-            ## (as firefox does).
-            ##
-            ## If you are running on a debian/ubuntu system,
-            ## mozilla certificates are located in
-            ## /usr/share/ca-certificates/mozilla/ .You can concatenate
-            ## them with the command :
-            ## for cert in /usr/share/ca-certificates/mozilla/*crt; \
-            ##      do cat $cert >> mozcerts.pem; done
-            ##
-            ## You may want to bundle *only* your server certificate/your ca
-            ## certificate with your application to make it more secure.
-            conn = HTTPSConnection(host, ca_certs)
-        else:
-            conn = httplib.HTTPConnection(host, port)
-        return conn
+        # concurrent requests must not prompt for credentials at once
+        with auth_lock:
+            cookie_auth = auth_cookie()
+            if cookie_auth is not None:
+                log.debug('Use cookie: %s' % cookie_auth)
+                headers.update(cookie_auth)
+                # the server may reject the cookie (expired, revoked or
+                # logged out elsewhere). Don't send a large body for nothing
+                expect = True
+            else:
+                log.debug('Use auth basic')
+                headers.update(auth_basic())
 
-    host = host or config.pytheon.api_host or 'api.pytheon.net:443'
-    try:
-        conn = get_conn(host)
-        conn.request(method, path, params, headers)
-        resp = conn.getresponse()
-    except socket.error:
-        raise
-        raise OSError('Unable to contact %s' % host)
+    if params is not None and 'Content-Encoding' not in headers:
+        count(sent=len(params), sent_wire=len(params))
+
+    conn, resp = send_with_retry(host, method, path, params, headers,
+                                 timeout, retry, expect)
 
     if resp.status == 401 and cookie_auth is not None:
         log.info('Invalid password or session is expired')
-        headers.update(auth_basic(retry=True))
+        # consume the body so the connection can be reused
+        resp.read()
+        release(host, conn, resp)
+        with auth_lock:
+            headers.update(auth_basic(retry=True))
         del headers['Cookie']
-        conn = get_conn(host)
-        conn.request(method, path, params, headers)
-        resp = conn.getresponse()
+        conn, resp = send_with_retry(host, method, path, params, headers,
+                                     timeout, retry)
 
-    data = resp.read()
-    if resp.status != 200:
-        log.error("%d - %s " % (resp.status, resp.reason))
-        if resp.status == 500:
+    if stream and resp.status == 200:
+        save_cookie(resp.getheaders())
+        if responses is not None and method != 'GET':
+            responses.invalidate(path)
+        trace.annotate(status=resp.status)
+        body = Body(host, conn, resp)
+        if responses is not None and method == 'GET':
+            entry = cache.Entry(path, resp.getheaders(), '')
+            if entry.is_cacheable():
+                body.pipe(cache_body, responses, cache_key, entry)
+        if stream != 'chunks':
+            body.pipe(iter_lines)
+        if with_headers:
+            return resp.getheaders(), body
+        return body
+
+    with trace.span('read'):
+        data = read_body(resp)
+    release(host, conn, resp)
+    content_type = resp.getheader('Content-Type', 'text/plain')
+    status = resp.status
+    trace.annotate(status=status)
+    if status == 304 and cached is not None:
+        log.debug('Cached response for %s is still valid', path)
+        cached.revalidated(resp.getheaders())
+        responses.store(cache_key, cached)
+        data, content_type, status = cached.body, cached.content_type, 200
+    elif status == 200 and responses is not None:
+        if method == 'GET':
+            entry = cache.Entry(path, resp.getheaders(), data)
+            if entry.is_cacheable():
+                responses.store(cache_key, entry)
+        else:
+            responses.invalidate(path)
+
+    if status != 200:
+        log.error("%d - %s " % (status, resp.reason))
+        if status == 500:
             sys.exit(1)
 
     save_cookie(resp.getheaders())
-    if resp.getheader('Content-Type', 'text/plain') == 'application/json':
-        return json.loads(data)
+    if stream and status == 200:
+        # a revalidated cached response
+        body = cached_stream(content_type, data, stream)
+    else:
+        body = decode(content_type, data)
+    if with_headers:
+        return resp.getheaders(), body
+    return body
+
+
+COMPRESS_MIN_SIZE = 1024
+CHUNK_SIZE = 64 * 1024
+
+transfer_lock = threading.Lock()
+transfer_stats = dict(sent=0, sent_wire=0, received=0, received_wire=0)
+
+
+def count(**kwargs):
+    with transfer_lock:
+        for k, v in kwargs.items():
+            transfer_stats[k] += v
+
+
+def gzip_body(data):
+    """gzip a request body"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    count(sent=len(data), sent_wire=len(body))
+    return body
+
+
+class Decoder(object):
+    """Incremental decoder for gzip and deflate content encodings"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.obj = zlib.decompressobj()
+        self.started = False
+
+    def decode(self, chunk):
+        if self.encoding == 'deflate' and not self.started:
+            # some servers send a raw deflate stream without zlib header
+            self.started = True
+            try:
+                return self.obj.decompress(chunk)
+            except zlib.error:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.obj.decompress(chunk)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+def read_body(resp):
+    """read a response body and decode it if it is compressed"""
+    encoding = (resp.getheader('Content-Encoding', '') or '').lower()
+    if encoding not in ('gzip', 'deflate'):
+        data = resp.read()
+        count(received=len(data), received_wire=len(data))
+        return data
+    decoder = Decoder(encoding)
+    chunks = []
+    wire = 0
+    while True:
+        chunk = resp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        wire += len(chunk)
+        chunks.append(decoder.decode(chunk))
+    chunks.append(decoder.flush())
+    data = ''.join(chunks)
+    count(received=len(data), received_wire=wire)
+    log.debug('Received %s bytes (%s on wire)', len(data), wire)
     return data
+
+
+def iter_chunks(resp):
+    """yield body chunks as soon as they are received. Handle chunked
+    transfer encoding"""
+    fp = getattr(resp, 'fp', None)
+    chunked = getattr(resp, 'chunked', None)
+    if fp is None or chunked is None:
+        # not a httplib response
+        yield resp.read()
+        return
+    if chunked:
+        while True:
+            line = fp.readline()
+            if not line:
+                break
+            size = int(line.split(';', 1)[0], 16)
+            if size == 0:
+                # skip trailers
+                while fp.readline() not in ('\r\n', '\n', ''):
+                    pass
+                break
+            yield fp.read(size)
+            fp.read(2)
+    else:
+        # httplib uses an unbuffered file so reading from the socket is safe
+        recv = getattr(getattr(fp, '_sock', None), 'recv', fp.read)
+        remaining = resp.length
+        while remaining is None or remaining > 0:
+            chunk = recv(min(CHUNK_SIZE, remaining or CHUNK_SIZE))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    resp.length = 0
+    resp.close()
+
+
+class Body(object):
+    """Iterate over the decoded chunks of a streamed body as they are
+    received. The connection goes back to the pool once the body is fully
+    read. :meth:`close` closes it if the body was not fully read, even if it
+    was never iterated. Filters added with :meth:`pipe` transform the
+    chunks"""
+
+    def __init__(self, host, conn, resp):
+        self.host = host
+        self.conn = conn
+        self.resp = resp
+        self.content_type = resp.getheader('Content-Type', 'text/plain')
+        self.iterator = self.chunks()
+
+    def chunks(self):
+        resp = self.resp
+        encoding = (resp.getheader('Content-Encoding', '') or '').lower()
+        decoder = encoding in ('gzip', 'deflate') and Decoder(encoding) or None
+        complete = False
+        try:
+            for chunk in iter_chunks(resp):
+                count(received_wire=len(chunk))
+                if decoder is not None:
+                    chunk = decoder.decode(chunk)
+                count(received=len(chunk))
+                if chunk:
+                    yield chunk
+            if decoder is not None:
+                chunk = decoder.flush()
+                if chunk:
+                    yield chunk
+            complete = True
+        finally:
+            conn, self.conn = self.conn, None
+            if complete:
+                release(self.host, conn, resp)
+            elif conn is not None:
+                # the body was not fully read
+                close(conn)
+
+    def pipe(self, func, *args):
+        """iterate over ``func(chunks, *args)`` instead of the chunks"""
+        self.iterator = func(self.iterator, *args)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.iterator.next()
+
+    def close(self):
+        getattr(self.iterator, 'close', lambda: None)()
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            close(conn)
+
+
+class CachedBody(Body):
+    """A :class:`Body` read from the cache"""
+
+    def __init__(self, content_type, data):
+        self.host = self.conn = self.resp = None
+        self.content_type = content_type
+        self.iterator = iter([data])
+
+
+def cached_stream(content_type, data, stream):
+    """return a cached response as :func:`request` streams it"""
+    body = CachedBody(content_type, data)
+    if stream != 'chunks':
+        body.pipe(iter_lines)
+    return body
+
+
+def cache_body(chunks, responses, key, entry):
+    """yield chunks and store entry with the whole body once it's read.
+    Bodies larger than the cache are not stored"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > responses.max_size:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        entry.body = ''.join(parts)
+        responses.store(key, entry)
+
+
+def iter_lines(chunks):
+    """split body chunks in lines"""
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+JSON_SEPARATORS = re.compile(r'[ \t\r\n,]*')
+
+
+def iter_json_array(chunks):
+    """decode the elements of a JSON array from an iterable of strings while
+    they are received. Only the current element and the last chunk are kept
+    in memory. A body that is not an array is decoded and yielded whole"""
+    decoder = jsonlib.JSONDecoder()
+    chunks = iter(chunks)
+    buf, pos = '', 0
+    started = eof = False
+    while True:
+        length = len(buf)
+        pos = (started and JSON_SEPARATORS or JSON_WHITESPACE).match(
+                                                        buf, pos).end()
+        if pos < length:
+            if not started:
+                if buf[pos] != '[':
+                    yield decoder.decode(buf[pos:] + ''.join(chunks))
+                    return
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                # consume the rest so the connection is released
+                for chunk in chunks:
+                    pass
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # a value ending the buffer may be truncated (e.g. a number)
+            if end is not None and (end < length or eof):
+                yield value
+                pos = end
+                continue
+            if eof:
+                raise ValueError('Invalid JSON array: %r' % buf[pos:pos + 80])
+        elif eof:
+            if started:
+                raise ValueError('Unterminated JSON array')
+            return
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            eof = True
+            continue
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def json_values(body):
+    """return an iterator of the elements of a streamed JSON array. Empty if
+    the body is not JSON"""
+    if body.content_type != 'application/json':
+        log.error('Not a JSON response: %s', body.content_type)
+        return iter([])
+    return iter_json_array(body)
+
+
+def iter_json(path, **kwargs):
+    """yield the elements of the JSON array returned by path as
+    :class:`~pytheon.utils.JSONView` while the response is received. Extra
+    keyword arguments are passed to :func:`request`"""
+    kwargs.update(json=True, stream='chunks')
+    body = request(path, **kwargs)
+    if not isinstance(body, Body):
+        # an error. It is already logged
+        return
+    try:
+        for value in json_values(body):
+            yield utils.wrap_json(value)
+    finally:
+        # close the connection if the array is not fully read
+        getattr(body, 'close', lambda: None)()
+
+
+def decode(content_type, data):
+    if content_type == 'application/json':
+        with trace.span('decode'):
+            return jsonlib.loads(data)
+    return data
+
+
+LINK = re.compile(r'<([^>]*)>([^<]*)')
+
+
+def with_query(path, **query):
+    """return path with query parameters added or replaced"""
+    path, _, qs = path.partition('?')
+    params = [(k, v) for k, v in parse_qsl(qs) if k not in query]
+    params.extend(sorted(query.items()))
+    return params and '%s?%s' % (path, urlencode(params)) or path
+
+
+def next_page(headers, path):
+    """return the path of the page following path, from a ``Link: <...>;
+    rel="next"`` header or a ``X-Next-Cursor`` header. None on the last
+    page"""
+    headers = dict([(k.lower(), v) for k, v in headers])
+    for url, link_params in LINK.findall(headers.get('link', '')):
+        if re.search(r'rel="?next"?(;|,|\s|$)', link_params):
+            if '://' in url:
+                url = '/' + url.split('://', 1)[1].partition('/')[2]
+            return url
+    cursor = headers.get('x-next-cursor')
+    if cursor:
+        return with_query(path, cursor=cursor)
+    return None
+
+
+def close_page(future):
+    """close the body of a prefetched page which is not used"""
+    if future.exception() is None:
+        headers, body = future.result()
+        getattr(body, 'close', lambda: None)()
+
+
+def iter_listing(path, limit=None, fields=None, json=False, **kwargs):
+    """yield the items of a paginated listing: lines of a text listing or
+    :class:`~pytheon.utils.JSONView` of a JSON array.
+
+    Pages are followed with ``Link: <...>; rel="next"`` or
+    ``X-Next-Cursor`` headers. The next page is requested as soon as the
+    headers of the current page are received, so it is downloaded while the
+    current page is consumed. ``limit`` (max number of items) and ``fields``
+    (a list of names) are sent to the server, which may use them to return
+    less data. ``limit`` is also enforced here. Extra keyword arguments are
+    passed to :func:`request`"""
+    query = {}
+    if limit:
+        query['limit'] = limit
+    if fields:
+        query['fields'] = ','.join(fields)
+    kwargs.update(json=json, stream=json and 'chunks' or True,
+                  with_headers=True)
+    path = with_query(path, **query)
+    # the first page is requested here so credentials are resolved in the
+    # calling thread
+    page = request(path, **kwargs)
+    future = body = items = None
+    count = 0
+    try:
+        while page is not None:
+            headers, body = page
+            page = None
+            next_path = next_page(headers, path)
+            if next_path is not None:
+                path = next_path
+                future = request_async(path, **kwargs)
+            if isinstance(body, Body):
+                items = json and json_values(body) or body
+            elif not json and isinstance(body, basestring):
+                # an error. It is shown as the listing was
+                items = iter(body.splitlines(True))
+            else:
+                # an error. It is already logged
+                items = iter([])
+            for item in items:
+                if limit and count >= limit:
+                    return
+                count += 1
+                if json:
+                    item = utils.wrap_json(item)
+                yield item
+            body = items = None
+            if future is not None:
+                page, future = future.result(), None
+    finally:
+        # close what was not consumed. It closes the connections
+        for iterator in (items, body):
+            getattr(iterator, 'close', lambda: None)()
+        if future is not None and not future.cancel():
+            future.add_done_callback(close_page)
+
+
+def request_many(requests, concurrency=None, **kwargs):
+    """Send requests concurrently and return the results in the same order.
+    Each request is a ``(path, method, params)`` tuple where method and
+    params are optional. ``concurrency`` is the max number of requests in
+    flight. Default to ``concurrency`` in ``~/.pytheonrc`` or 4. Extra
+    keyword arguments are passed to :func:`request`.
+
+    The first request is sent alone so credentials are resolved (and the
+    session cookie saved) only once. If a request fails the first error is
+    raised once all requests are done."""
+    requests = [isinstance(r, basestring) and (r,) or tuple(r)
+                for r in requests]
+    if not requests:
+        return []
+    if concurrency is None:
+        config = utils.user_config()
+        concurrency = int(config.pytheon.concurrency or 4)
+    results = [None] * len(requests)
+    errors = []
+
+    def call(index):
+        path, method, params = (requests[index] + (None, None))[:3]
+        params = dict(kwargs, **(params or {}))
+        try:
+            results[index] = request(path, method=method or 'GET', **params)
+        except (Exception, SystemExit), e:
+            errors.append((index, e, sys.exc_info()[2]))
+
+    call(0)
+    queue = Queue.Queue()
+    for index in range(1, len(requests)):
+        queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            call(index)
+
+    workers = []
+    for i in range(min(max(concurrency, 1), len(requests) - 1)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+
+    if errors:
+        index, e, tb = sorted(errors)[0]
+        raise e.__class__, e, tb
+    return results
+
+
+class CancelledError(RuntimeError):
+    """The request was cancelled before it was sent"""
+
+
+class Timeout(RuntimeError):
+    """The result was not available in time"""
+
+
+class Future(object):
+    """Result of :func:`request_async`. Callbacks added with
+    :meth:`add_done_callback` are called with the future once it is done,
+    from the thread which completed it. Event loop users should forward them
+    to their loop (e.g. ``loop.call_soon_threadsafe``)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._state = 'pending'
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def cancel(self):
+        """cancel the request if it was not sent yet. Return True on
+        success"""
+        with self._lock:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """wait for the response and return it. Raise the request error, if
+        any, :class:`CancelledError` or :class:`Timeout`"""
+        if not self._event.wait(timeout):
+            raise Timeout('No response after %ss' % timeout)
+        if self._state == 'cancelled':
+            raise CancelledError()
+        if self._error is not None:
+            e, tb = self._error
+            raise e.__class__, e, tb
+        return self._result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except (CancelledError, Timeout):
+            raise
+        except (Exception, SystemExit), e:
+            return e
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_running(self):
+        with self._lock:
+            if self._state != 'pending':
+                return False
+            self._state = 'running'
+            return True
+
+    def set_result(self, result):
+        self._result = result
+        self._state = 'finished'
+        self._finish()
+
+    def set_exception(self, e, tb=None):
+        self._error = (e, tb)
+        self._state = 'finished'
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception('Error in request callback')
+
+
+class Executor(object):
+    """A fixed set of daemon threads sending requests queued by
+    :func:`request_async`. Threads are started on first use. ``size``
+    defaults to ``concurrency`` in ``~/.pytheonrc`` or 4."""
+
+    def __init__(self, size=None):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            size = self.size
+            if size is None:
+                config = utils.user_config()
+                size = int(config.pytheon.concurrency or 4)
+            for i in range(max(size, 1)):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        self.start()
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def work(self):
+        while True:
+            future, func, args, kwargs = self.queue.get()
+            if not future.set_running():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except (Exception, SystemExit), e:
+                future.set_exception(e, sys.exc_info()[2])
+            else:
+                future.set_result(result)
+
+executor = Executor()
+
+
+def request_async(path, callback=None, **kwargs):
+    """Queue a :func:`request` and return a :class:`Future` immediately.
+    ``callback`` is added to the future. Use ``timeout`` to limit the time
+    spent waiting for the server. Requests share the connection pool and the
+    credentials of :func:`request`"""
+    future = executor.submit(request, path, **kwargs)
+    if callback is not None:
+        future.add_done_callback(callback)
+    return future
@@ -15,6 +15,18 @@ Valid project commands are:
 
     %s
 
+Global options:
+
+    --trace FILE      write a Chrome trace of HTTP requests to FILE (or a
+                      summary table to stdout if FILE is -)
+    --profile[=FILE]  profile the command. Write pstats to FILE (default:
+                      pytheon.prof) or collapsed stacks for flamegraphs if
+                      FILE ends with .folded
+
+apps, addons, add_key and batch FILE are forwarded to the agent started
+with `%%prog agent` when it is running. Set PYTHEON_NO_AGENT=1 to disable
+it.
+
 Get help on each command with: %%prog [command] -h''' % (
     '\n    '.join(sorted(commands.commands)),
     '\n    '.join(sorted(commands.project_commands)))
@@ -26,8 +38,61 @@ else:
     log.basicConfig(stream=sys.stdout, level=log.INFO, format='%(message)s')
 
 
+def pop_option(args, name):
+    """remove ``name VALUE`` or ``name=VALUE`` from args and return VALUE or
+    None"""
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            value = args[i + 1]
+            del args[i:i + 2]
+            return value
+        elif arg.startswith(name + '='):
+            del args[i]
+            return arg[len(name) + 1:]
+    return None
+
+
+def pop_flag(args, name, default):
+    """remove ``name`` or ``name=VALUE`` from args and return VALUE, default
+    or None"""
+    for i, arg in enumerate(args):
+        if arg == name:
+            del args[i]
+            return default
+        elif arg.startswith(name + '='):
+            del args[i]
+            return arg[len(name) + 1:]
+    return None
+
+
 def main(args=None, testing=False, **kwargs):
     args = args or sys.argv[1:]
+    trace_file = pop_option(args, '--trace')
+    profile_file = pop_flag(args, '--profile', 'pytheon.prof')
+    if trace_file is not None:
+        from pytheon import trace
+        trace.enabled = True
+    elif not testing and profile_file is None and args:
+        from pytheon import agent
+        status = agent.forward(args)
+        if status:
+            sys.exit(status)
+        elif status is not None:
+            return ''
+    try:
+        if profile_file is not None:
+            from pytheon import profiling
+            return profiling.run(profile_file, dispatch, args,
+                                 testing=testing, **kwargs)
+        return dispatch(args, testing=testing, **kwargs)
+    finally:
+        if trace_file is not None:
+            trace.dump(trace_file)
+            trace.enabled = False
+            trace.reset()
+
+
+def dispatch(args, testing=False, **kwargs):
     if args:
         try:
             cmd = args.pop(0)
@@ -36,15 +101,10 @@ def main(args=None, testing=False, **kwargs):
             print e
         else:
             result = cmd(args, **kwargs)
-            if isinstance(result, basestring):
-                for line in result.strip().split('\n'):
-                    line = line.strip()
-                    if line.startswith('! '):
-                        log.error(line[2:])
-                    else:
-                        log.info(line)
-                    if testing:
-                        return result.strip()
+            if commands.is_output(result):
+                result = commands.log_result(result)
+                if testing:
+                    return result.strip()
             return ''
     parser.parse_args(['-h'])
 
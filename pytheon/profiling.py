@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import os
+import sys
+import time
+import signal
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# files with these extensions get collapsed stacks (flamegraph.pl input)
+COLLAPSED = ('.folded', '.collapsed')
+
+
+class StackSampler(object):
+    """Sample the stack of the main thread every ``interval`` seconds of CPU
+    time and count identical stacks. The result is written in the collapsed
+    format used by flamegraph.pl"""
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.counts = {}
+        self.previous = None
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    def runcall(self, func, *args, **kwargs):
+        self.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop()
+
+    def dump_stats(self, filename):
+        with open(filename, 'w') as fd:
+            for stack, count in sorted(self.counts.items()):
+                fd.write('%s %s\n' % (stack, count))
+
+
+def cpu_time():
+    if resource is None:
+        return time.clock()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+    """peak resident set size in MB"""
+    if resource is None:
+        return 0.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on OSX, KB elsewhere
+        return rss / 1024. / 1024.
+    return rss / 1024.
+
+
+def run(filename, func, *args, **kwargs):
+    """call func in a profiler and write the result to filename. pstats
+    format is used unless filename ends with ``.folded`` or ``.collapsed``.
+    Log wall time, CPU time and peak RSS"""
+    if filename.endswith(COLLAPSED):
+        profiler = StackSampler()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+    wall, cpu = time.time(), cpu_time()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        wall, cpu = time.time() - wall, cpu_time() - cpu
+        profiler.dump_stats(filename)
+        log.info('Profile written to %s', filename)
+        log.info('wall %.3fs cpu %.3fs peak rss %.1fMB',
+                 wall, cpu, peak_rss())
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""A deduplicated backup store. Dumps are cut in content defined chunks
+stored once, compressed, under their sha256. A backup is a manifest listing
+its chunks, so data unchanged since the previous backup costs no space and
+no write.
+
+Layout::
+
+    <directory>/chunks/ab/abcdef...  zlib compressed chunks
+    <directory>/backups/<name>.json  manifests
+    <directory>/lock                 held (shared) by running backups and
+                                     (exclusive) by :meth:`ChunkStore.collect`
+"""
+from __future__ import with_statement
+import os
+import re
+import time
+import zlib
+import fcntl
+import Queue
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+from pytheon import utils
+from pytheon.compat import json
+
+log = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+# chunks are cut at the end of a line whose crc32 matches MASK once they are
+# larger than MIN_CHUNK. Lines longer than MAX_CHUNK are cut anywhere
+MIN_CHUNK = 512 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+MASK = 0x3f
+
+# date formats of the retention periods
+PERIODS = (('daily', '%Y-%m-%d'), ('weekly', '%Y-%W'), ('monthly', '%Y-%m'))
+
+
+class StoreError(RuntimeError):
+    """A backup is missing or corrupted"""
+
+
+def split(read, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=MASK):
+    """yield content defined chunks of what ``read(size)`` returns. Cuts
+    only depend on the content of the last line so an insertion in a dump
+    only changes the chunks around it. Chunks are never larger than
+    max_size"""
+    crc32 = zlib.crc32
+    pieces = []
+    size = 0
+    pending = ''
+    while True:
+        data = read(READ_SIZE)
+        if not data:
+            break
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            length = len(line) + 1
+            if pieces and size + length > max_size:
+                yield ''.join(pieces)
+                pieces = []
+                size = 0
+            if length > max_size:
+                # cut long lines anywhere
+                tail = line + '\n'
+                while len(tail) > max_size:
+                    yield tail[:max_size]
+                    tail = tail[max_size:]
+                pieces.append(tail)
+                size = len(tail)
+            else:
+                pieces.append(line)
+                pieces.append('\n')
+                size += length
+            if size >= max_size or \
+               (size >= min_size and crc32(line) & mask == 0):
+                yield ''.join(pieces)
+                pieces = []
+                size = 0
+        if len(pending) >= max_size and pieces:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+        while len(pending) >= max_size:
+            yield pending[:max_size]
+            pending = pending[max_size:]
+    if pieces and size + len(pending) > max_size:
+        yield ''.join(pieces)
+        pieces = []
+    pieces.append(pending)
+    last = ''.join(pieces)
+    if last:
+        yield last
+
+
+def imap(func, items, jobs):
+    """like :func:`itertools.imap` but func is called by ``jobs`` threads.
+    Results are yielded in order. At most ``2 * jobs`` items are processed
+    in advance"""
+    tasks = Queue.Queue()
+    window = deque()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, item = task
+            try:
+                slot[1] = func(item)
+            except Exception, e:
+                slot[2] = e
+            slot[0].set()
+
+    threads = [threading.Thread(target=work) for i in range(max(jobs, 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    items = iter(items)
+    try:
+        while True:
+            while len(window) < 2 * len(threads):
+                try:
+                    item = items.next()
+                except StopIteration:
+                    break
+                slot = [threading.Event(), None, None]
+                window.append(slot)
+                tasks.put((slot, item))
+            if not window:
+                return
+            slot = window.popleft()
+            slot[0].wait()
+            if slot[2] is not None:
+                raise slot[2]
+            yield slot[1]
+    finally:
+        for thread in threads:
+            tasks.put(None)
+
+
+def parse_date(name):
+    """return the date of a ``<database>-<YYYYmmddHHMM>`` backup or None"""
+    stamp = os.path.basename(name).split('.', 1)[0].rsplit('-', 1)[-1]
+    try:
+        return datetime.strptime(stamp, '%Y%m%d%H%M')
+    except ValueError:
+        return None
+
+
+def dated_backups(names, database):
+    """return ``{name: date}`` for the names which are backups of database.
+    Backups of ``app-old`` are not backups of ``app``"""
+    pattern = re.compile(re.escape(database) + r'-\d{12}(\.|$)')
+    dates = {}
+    for name in names:
+        if pattern.match(name):
+            date = parse_date(name)
+            if date is not None:
+                dates[name] = date
+    return dates
+
+
+def expired(dates, daily=0, weekly=0, monthly=0):
+    """return the names of ``{name: date}`` which are not kept by the
+    retention policy: the last backup of the ``daily`` last days, of the
+    ``weekly`` last weeks and of the ``monthly`` last months"""
+    counts = dict(daily=daily, weekly=weekly, monthly=monthly)
+    newest = sorted(dates, key=lambda name: dates[name], reverse=True)
+    keep = set()
+    for period, format in PERIODS:
+        seen = set()
+        for name in newest:
+            key = dates[name].strftime(format)
+            if key in seen:
+                continue
+            if len(seen) >= counts[period]:
+                break
+            seen.add(key)
+            keep.add(name)
+    return [name for name in newest if name not in keep]
+
+
+def retention_policy(config=None):
+    """return the ``backup_keep_daily``, ``backup_keep_weekly`` and
+    ``backup_keep_monthly`` values of ``~/.pytheonrc`` as keyword arguments
+    of :func:`expired`. Empty if no policy is configured"""
+    config = config or utils.user_config()
+    policy = {}
+    for period, format in PERIODS:
+        value = config.pytheon['backup_keep_%s' % period]
+        if value:
+            policy[period] = int(value)
+    return policy
+
+
+class ChunkStore(object):
+    """Store backups in directory. See the module documentation"""
+
+    def __init__(self, directory, level=6, min_size=MIN_CHUNK,
+                 max_size=MAX_CHUNK, mask=MASK):
+        self.directory = directory
+        self.level = level
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self.lock = threading.Lock()
+        # lock file held from backup() to save()
+        self.writing = None
+
+    def flock(self, operation):
+        """return the lock file of the store locked with operation"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        fd = open(os.path.join(self.directory, 'lock'), 'a')
+        try:
+            fcntl.flock(fd.fileno(), operation)
+        except:
+            fd.close()
+            raise
+        return fd
+
+    def release(self):
+        """release the lock taken by :meth:`backup`. Called by :meth:`save`
+        or when the backup is aborted"""
+        if self.writing is not None:
+            self.writing.close()
+            self.writing = None
+
+    def chunk_path(self, key):
+        return os.path.join(self.directory, 'chunks', key[:2], key)
+
+    def manifest_path(self, name):
+        return os.path.join(self.directory, 'backups', name + '.json')
+
+    def put(self, key, data):
+        """store a chunk unless it's already there. Return the number of
+        bytes written"""
+        filename = self.chunk_path(key)
+        if os.path.exists(filename):
+            return 0
+        obj = zlib.compressobj(self.level)
+        data = obj.compress(data) + obj.flush()
+        dirname = os.path.dirname(filename)
+        with self.lock:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, 0700)
+        utils.atomic_write(filename, lambda fd: fd.write(data))
+        return len(data)
+
+    def get(self, key):
+        """return the content of a chunk. Raise :class:`StoreError` if it's
+        missing or corrupted"""
+        try:
+            with open(self.chunk_path(key), 'rb') as fd:
+                data = zlib.decompress(fd.read())
+        except (IOError, zlib.error), e:
+            raise StoreError('Chunk %s: %s' % (key, e))
+        if hashlib.sha256(data).hexdigest() != key:
+            raise StoreError('Chunk %s is corrupted' % key)
+        return data
+
+    def backup(self, fd, jobs=4):
+        """store the content of fd. Chunks are compressed and written by
+        ``jobs`` threads. Return the manifest, which is not saved. The store
+        is locked so :meth:`collect` does not remove the new chunks until
+        :meth:`save` or :meth:`release` is called"""
+        if self.writing is None:
+            self.writing = self.flock(fcntl.LOCK_SH)
+        start = time.time()
+        digest = hashlib.sha256()
+        chunks = []
+        seen = set()
+
+        def cut():
+            for data in split(fd.read, self.min_size, self.max_size,
+                              self.mask):
+                digest.update(data)
+                key = hashlib.sha256(data).hexdigest()
+                chunks.append([key, len(data)])
+                if key not in seen:
+                    seen.add(key)
+                    yield key, data
+
+        written = 0
+        for size in imap(lambda chunk: self.put(*chunk), cut(), jobs):
+            written += size
+        return dict(size=sum([c[1] for c in chunks]),
+                    sha256=digest.hexdigest(), chunks=chunks,
+                    written=written, seconds=time.time() - start)
+
+    def save(self, name, manifest):
+        filename = self.manifest_path(name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0700)
+        manifest = dict(manifest, name=name)
+        try:
+            utils.atomic_write(filename, lambda fd: json.dump(manifest, fd))
+        finally:
+            self.release()
+
+    def manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as fd:
+                return json.load(fd)
+        except IOError:
+            raise StoreError('No backup named %s' % name)
+
+    def backups(self):
+        """return backup names, oldest first"""
+        dirname = os.path.join(self.directory, 'backups')
+        if not os.path.isdir(dirname):
+            return []
+        return sorted([n[:-5] for n in os.listdir(dirname)
+                       if n.endswith('.json')])
+
+    def restore(self, name, fd, jobs=4):
+        """write the content of a backup to fd. Chunks are read and checked
+        by ``jobs`` threads. Raise :class:`StoreError` if the restored data
+        does not match the checksum of the backup"""
+        manifest = self.manifest(name)
+        digest = hashlib.sha256()
+        keys = [key for key, size in manifest['chunks']]
+        for data in imap(self.get, keys, jobs):
+            digest.update(data)
+            fd.write(data)
+        if digest.hexdigest() != manifest['sha256']:
+            raise StoreError('Backup %s is corrupted' % name)
+
+    def verify(self, name, jobs=4):
+        """read all chunks of a backup. Return a list of errors"""
+        manifest = self.manifest(name)
+        keys = sorted(set([key for key, size in manifest['chunks']]))
+
+        def check(key):
+            try:
+                self.get(key)
+            except StoreError, e:
+                return str(e)
+
+        return [error for error in imap(check, keys, jobs) if error]
+
+    def prune(self, database, **policy):
+        """remove the backups of database not kept by the retention policy
+        (see :func:`expired`) then the chunks they were the only one to use.
+        Return the removed backup names"""
+        names = expired(dated_backups(self.backups(), database), **policy)
+        for name in names:
+            log.info('Remove backup %s', name)
+            os.remove(self.manifest_path(name))
+        if names:
+            self.collect()
+        return names
+
+    def collect(self):
+        """remove chunks used by no backup. Return their number. Wait for
+        running backups whose chunks are not in a manifest yet"""
+        root = os.path.join(self.directory, 'chunks')
+        if not os.path.isdir(root):
+            return 0
+        lock = self.flock(fcntl.LOCK_EX)
+        try:
+            used = set()
+            for name in self.backups():
+                used.update([key for key, size in
+                             self.manifest(name)['chunks']])
+            removed = 0
+            for prefix in os.listdir(root):
+                for key in os.listdir(os.path.join(root, prefix)):
+                    # skip temporary files
+                    if key not in used and not key.startswith('.'):
+                        os.remove(os.path.join(root, prefix, key))
+                        removed += 1
+        finally:
+            lock.close()
+        return removed
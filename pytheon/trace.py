@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import os
+import time
+import logging
+import functools
+import threading
+from pytheon.compat import json
+
+log = logging.getLogger(__name__)
+
+# record spans in ``spans`` (--trace)
+enabled = False
+# callbacks called with each finished :class:`Span`
+hooks = []
+spans = []
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span(object):
+    """A timed step of a request: ``request``, ``dns``, ``tcp``, ``tls``,
+    ``send``, ``ttfb``, ``read`` or ``decode``"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.parent = None
+        self.children = []
+        self.thread = threading.current_thread().ident
+        self.start = self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.parent = stack[-1]
+            self.parent.children.append(self)
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = time.time()
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if enabled:
+            with _lock:
+                spans.append(self)
+        for hook in hooks:
+            try:
+                hook(self)
+            except Exception:
+                log.exception('Error in trace hook')
+        return False
+
+    def __repr__(self):
+        return '<Span %s %.3fs>' % (self.name, self.duration)
+
+
+class NullSpan(object):
+
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL = NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def span(name, **args):
+    """return a context manager timing a step. A no-op when nothing is
+    tracing"""
+    if not enabled and not hooks:
+        return NULL
+    return Span(name, args)
+
+
+def annotate(**args):
+    """add arguments to the current span"""
+    stack = _stack()
+    if stack:
+        stack[-1].args.update(args)
+
+
+def traced(name):
+    """decorator running a function in a span"""
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return wrapper
+
+
+def reset():
+    with _lock:
+        del spans[:]
+
+
+def summary():
+    """return a table of traced requests with the time spent in each step"""
+    steps = ('dns', 'tcp', 'tls', 'send', 'ttfb', 'read', 'decode')
+    lines = ['%-7s %-40s %6s %9s ' % ('method', 'path', 'status', 'total') +
+             ' '.join(['%7s' % s for s in steps])]
+    totals = dict([(s, 0.) for s in steps + ('total',)])
+    requests = [s for s in spans if s.name == 'request']
+    for request in requests:
+        times = dict([(s, 0.) for s in steps])
+        for child in request.children:
+            if child.name in times:
+                times[child.name] += child.duration
+        for s in steps:
+            totals[s] += times[s]
+        totals['total'] += request.duration
+        lines.append('%-7s %-40s %6s %7.1fms ' % (
+                        request.args.get('method', ''),
+                        request.args.get('path', '')[:40],
+                        request.args.get('status', ''),
+                        request.duration * 1000) +
+                     ' '.join(['%5.1fms' % (times[s] * 1000) for s in steps]))
+    lines.append('%-7s %-40s %6s %7.1fms ' % (
+                    '', '%s requests' % len(requests), '',
+                    totals['total'] * 1000) +
+                 ' '.join(['%5.1fms' % (totals[s] * 1000) for s in steps]))
+    return '\n'.join(lines)
+
+
+def chrome_trace():
+    """return spans in the Chrome trace event format (chrome://tracing)"""
+    pid = os.getpid()
+    events = []
+    for s in spans:
+        events.append(dict(name=s.name, ph='X', pid=pid, tid=s.thread,
+                           ts=int(s.start * 1e6),
+                           dur=int((s.end - s.start) * 1e6),
+                           args=dict([(k, str(v))
+                                      for k, v in s.args.items()])))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+
+def dump(filename):
+    """write a Chrome trace to filename. Log the summary if filename is
+    ``-``"""
+    if filename == '-':
+        for line in summary().split('\n'):
+            log.info(line)
+        return
+    with open(filename, 'w') as fd:
+        json.dump(chrome_trace(), fd)
+    log.info('Trace written to %s', filename)
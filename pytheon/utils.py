@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
 import os
 import sys
 import socket
 import logging
+import tempfile
+import threading
 import subprocess
 from os.path import join
 from pytheon.compat import PY3
 from pytheon.compat import json
-from pytheon.compat import urlopen
 from ConfigObject import ConfigObject
 
 
@@ -38,6 +40,177 @@ class JSON(dict):
         return json.dumps(self)
 
 
+CONTAINERS = (dict, list, tuple)
+
+
+def wrap_json(value):
+    """return a view of value if it's a dict or a list"""
+    if isinstance(value, dict):
+        return JSONView(value)
+    elif isinstance(value, (list, tuple)):
+        return JSONList(value)
+    return value
+
+
+class JSONView(object):
+    """A view on a decoded JSON object with the same attribute access as
+    :class:`JSON`. The decoded data is not copied: nested objects and lists
+    are wrapped on first access and the values are cached in the view, so
+    the underlying data must not be modified while the view is used. A first
+    walk of the whole data is slower than with :class:`JSON`, later ones are
+    faster"""
+
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data):
+        if data.__class__ is not dict:
+            if isinstance(data, basestring):
+                data = json.loads(data)
+            data = data or {}
+        self._data = data
+        self._children = {}
+
+    def __getattr__(self, attr):
+        children = self._children
+        if attr in children:
+            return children[attr]
+        if attr[:2] == '__':
+            raise AttributeError(attr)
+        value = self._data.get(attr)
+        cls = value.__class__
+        if cls is dict:
+            value = JSONView(value)
+        elif cls in CONTAINERS:
+            value = wrap_json(value)
+        children[attr] = value
+        return value
+
+    def _child(self, key):
+        """wrap and cache the value of key"""
+        value = self._data.get(key)
+        if value.__class__ in CONTAINERS:
+            value = wrap_json(value)
+        self._children[key] = value
+        return value
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        return self.get(key)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        if key in self._children:
+            return self._children[key]
+        return self._child(key)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return [self.get(k) for k in self._data]
+
+    def items(self):
+        return [(k, self.get(k)) for k in self._data]
+
+    def iterkeys(self):
+        return iter(self._data)
+
+    def itervalues(self):
+        for k in self._data:
+            yield self.get(k)
+
+    def iteritems(self):
+        for k in self._data:
+            yield k, self.get(k)
+
+    def has_key(self, key):
+        return key in self._data
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, JSONView):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<JSONView %r>' % (self._data,)
+
+    def __str__(self):
+        return json.dumps(self._data)
+
+
+class JSONList(object):
+    """A view on a decoded JSON list. The list is not copied: objects and
+    lists are wrapped on first access, by index, and the wrappers are
+    cached"""
+
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data):
+        self._data = data
+        # {index: wrapper}
+        self._children = {}
+
+    def __getitem__(self, index):
+        data = self._data
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(data)))]
+        if index < 0:
+            index += len(data)
+        items = self._children
+        if index in items:
+            return items[index]
+        value = data[index]
+        if value.__class__ in CONTAINERS:
+            value = items[index] = wrap_json(value)
+        return value
+
+    def __iter__(self):
+        items = self._children
+        index = 0
+        for value in self._data:
+            cls = value.__class__
+            if cls in CONTAINERS:
+                if index in items:
+                    value = items[index]
+                elif cls is dict:
+                    value = items[index] = JSONView(value)
+                else:
+                    value = items[index] = wrap_json(value)
+            yield value
+            index += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, JSONList):
+            other = other._data
+        return list(self._data) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<JSONList %r>' % (self._data,)
+
+    def __str__(self):
+        return json.dumps(self._data)
+
+
 class Config(ConfigObject):
 
     filename = None
@@ -46,12 +219,14 @@ class Config(ConfigObject):
         if path_or_fd is None and self._filename:
             path_or_fd = self._filename
         if isinstance(path_or_fd, basestring):
-            fd = open(path_or_fd, 'w')
+            with write_lock:
+                atomic_write(path_or_fd,
+                             lambda fd: ConfigObject.write(self, fd))
+                with configs_lock:
+                    if configs.get(path_or_fd, (None, None))[1] is self:
+                        configs[path_or_fd] = (file_stamp(path_or_fd), self)
         else:
-            fd = path_or_fd
-        ConfigObject.write(self, fd)
-        if isinstance(path_or_fd, basestring):
-            fd.close()
+            ConfigObject.write(self, path_or_fd)
 
     @classmethod
     def from_file(cls, filename, **kwargs):
@@ -67,9 +242,61 @@ class Config(ConfigObject):
         return config
 
 
+configs = {}
+configs_lock = threading.Lock()
+# held while a cached config is modified and written. Configs are shared by
+# threads (e.g. the session refresh of pytheon.http)
+write_lock = threading.RLock()
+
+
+def file_stamp(filename):
+    """return a value which change when filename is modified or replaced"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def atomic_write(filename, write, mode=None):
+    """call ``write(fd)`` on a temporary file then rename it to filename so
+    concurrent readers never see a partial file. The file keeps the mode of
+    the file it replaces unless ``mode`` is given"""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(
+                prefix='.%s.' % os.path.basename(filename), dir=dirname)
+    try:
+        if mode is None and os.path.isfile(filename):
+            mode = os.stat(filename).st_mode & 0777
+        elif mode is None:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, 'w') as fileobj:
+            write(fileobj)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def cached_config(filename):
+    """parse filename once per process. The file is parsed again if it
+    changed on disk"""
+    stamp = file_stamp(filename)
+    with configs_lock:
+        cached_stamp, config = configs.get(filename, (None, None))
+        if config is None or cached_stamp != stamp:
+            config = Config.from_file(filename)
+            configs[filename] = (stamp, config)
+    return config
+
+
 def user_config():
     filename = os.path.expanduser('~/.pytheonrc')
-    return Config.from_file(filename)
+    return cached_config(filename)
 
 
 def user():
@@ -145,6 +372,7 @@ def buildout(interpreter, buildout='pytheon.cfg', eggs=None, env={}):
         return
 
     if not os.path.isfile('pytheon-bootstrap.py'):
+        from pytheon.compat import urlopen
         bootstrap_url = 'https://raw.github.com/'
         if ver[0] == '3':
             bootstrap_url += 'buildout/buildout/2/bootstrap/bootstrap.py'
@@ -175,7 +403,14 @@ def buildout(interpreter, buildout='pytheon.cfg', eggs=None, env={}):
     call(buildout_bin, '-c', buildout, env=env)
 
 
+# called instead of reading stdin when set. Used by the agent to ask the
+# user of the forwarding client (see pytheon.agent)
+input_hook = None
+
+
 def get_input(prompt='', default=None, password=None):
+    if input_hook is not None:
+        return input_hook(prompt, default, password)
     if password:
         if 'TEST_PASSWORD' in os.environ:
             return os.environ['TEST_PASSWORD']
@@ -211,7 +446,112 @@ def current_branch():
     return call('git', 'branch', '--no-color', silent=True).strip().strip('* ')
 
 
+# {cnf filename: (file_stamp, url)}
+sql_urls = {}
+sql_urls_lock = threading.Lock()
+
+# databases found on the server are cached here, keyed by cnf filename
+DATABASES_CACHE = '~/.pytheon/databases.json'
+SYSTEM_DATABASES = ('information_schema', 'performance_schema', 'mysql',
+                    'sys')
+
+
+def cached_database(cnf, stamp, db=None):
+    """return the database found for cnf when it had this stamp. Store db
+    if given"""
+    filename = os.path.expanduser(DATABASES_CACHE)
+    try:
+        with open(filename) as fd:
+            cache = json.load(fd)
+    except (IOError, ValueError):
+        cache = {}
+    entry = cache.get(cnf)
+    if db is None:
+        if entry and entry['stamp'] == list(stamp):
+            return entry['db']
+        return None
+    cache[cnf] = dict(stamp=stamp, db=db)
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0700)
+        atomic_write(filename, lambda fd: json.dump(cache, fd))
+    except (IOError, OSError), e:
+        log.debug('Can not write %s: %s', filename, e)
+    return db
+
+
+def find_database(client):
+    """return the database of the user by querying the server: the last
+    non system database with MySQL, the last database owned by the user with
+    PostgreSQL"""
+    import sqlalchemy
+    from sqlalchemy.pool import NullPool
+    if client.p == 'mysql':
+        url = '%(p)s://%(user)s:%(pass)s@%(host)s:%(port)s/' % client
+        query = sqlalchemy.text('SHOW DATABASES')
+        params = {}
+    else:
+        url = '%(p)s://%(user)s:%(pass)s@%(host)s:%(port)s/postgres' % client
+        query = sqlalchemy.text(
+            'SELECT d.datname FROM pg_database d '
+            'JOIN pg_roles r ON r.oid = d.datdba '
+            'WHERE r.rolname = :user AND NOT d.datistemplate '
+            'ORDER BY d.datname')
+        params = dict(user=client.user)
+    try:
+        engine = sqlalchemy.create_engine(url, poolclass=NullPool)
+        try:
+            rows = engine.execute(query, **params).fetchall()
+        finally:
+            engine.dispose()
+    except Exception, e:
+        log.debug('Can not list databases: %s', e)
+        return None
+    names = [row[0] for row in rows if row[0] not in SYSTEM_DATABASES]
+    return names and names[-1] or None
+
+
+def read_sql_url(cnf, prefix, stamp):
+    """build the url from cnf. The database is found on the server if it's
+    not in cnf"""
+    cfg = Config.from_file(cnf)
+    client = cfg.client
+    client.p = prefix
+    if 'pass' not in client:
+        client['pass'] = client.password
+    if 'host' not in client:
+        client.host = '127.0.0.1'
+    if 'port' not in client:
+        if prefix == 'mysql':
+            client.port = '3306'
+        else:
+            client.port = '5432'
+    if 'db' in cfg.pytheon:
+        client.db = cfg.pytheon.db
+    if 'db' not in client:
+        db = cached_database(cnf, stamp)
+        if db is None:
+            db = find_database(client)
+            if db is not None:
+                cached_database(cnf, stamp, db)
+        if db is not None:
+            client.db = db
+    try:
+        url = '%(p)s://%(user)s:%(pass)s@%(host)s:%(port)s/%(db)s' % client
+    except KeyError:
+        url = None
+    if url is None or not client.db:
+        # missing values are empty strings
+        log.error('Can not determine a valid url from %s' % cnf)
+        return None
+    log.info('Using %(p)s://%(user)s:XXXs@%(host)s:%(port)s/%(db)s' % client)
+    return url
+
+
 def get_sql_url():
+    """return the url of the database from the environment or from
+    ``~/.my.cnf`` or ``~/.pg.cnf``. The url is resolved once per process
+    unless the cnf file changes. Failures are not remembered"""
     for key in ('PG_URL', 'MYSQL_URL', 'SQLITE_URL'):
         if key in os.environ:
             return os.environ[key]
@@ -223,88 +563,197 @@ def get_sql_url():
         if os.path.isfile(cnf):
             prefix = 'postgresql'
     if os.path.isfile(cnf):
-        cfg = Config.from_file(cnf)
-        client = cfg.client
-        client.p = prefix
-        if 'pass' not in client:
-            client['pass'] = client.password
-        if 'host' not in client:
-            client.host = '127.0.0.1'
-        if 'port' not in client:
-            if prefix == 'mysql':
-                client.port = '3306'
-            else:
-                client.port = '5432'
-        if 'db' in cfg.pytheon:
-            client.db = cfg.pytheon.db
-        if 'db' not in client and prefix == 'mysql':
-            p = subprocess.Popen(
-                'echo "show databases" | mysql -h %(host)s | tail -1' % client,
-                shell=True, stdout=subprocess.PIPE)
-            db = p.stdout.read().strip()
-            if db not in ('Database', 'information_schema'):
-                client.db = db
-        elif 'db' not in client and prefix == 'postgresql':
-            p = subprocess.Popen(
-                'psql -l | grep `whoami` | tail -n 1 | cut -d' ' -f2',
-                shell=True, stdout=subprocess.PIPE)
-            db = p.stdout.read().strip()
-            if db not in ('Database', 'information_schema'):
-                client.db = db
-
-        try:
-            url = '%(p)s://%(user)s:%(pass)s@%(host)s:%(port)s/%(db)s' % client
-        except KeyError:
-            log.error('Can not determine a valid url from %s' % cnf)
-        else:
-            log.info(
-               'Using %(p)s://%(user)s:XXXs@%(host)s:%(port)s/%(db)s' % client)
+        stamp = file_stamp(cnf)
+        with sql_urls_lock:
+            cached_stamp, url = sql_urls.get(cnf, (None, None))
+            if cached_stamp != stamp:
+                url = read_sql_url(cnf, prefix, stamp)
+                # the server may not be up yet. Try again on the next call
+                if url:
+                    sql_urls[cnf] = (stamp, url)
+        if url:
             if prefix == 'mysql':
                 os.environ['MYSQL_URL'] = url
             else:
                 os.environ['PG_URL'] = url
-            return url
+        return url
+
+
+# deploy.ini [deploy] options tuning the pools of engine_from_config
+POOL_OPTIONS = (('sql_pool_size', 'pool_size', int),
+                ('sql_max_overflow', 'max_overflow', int),
+                ('sql_pool_timeout', 'pool_timeout', int),
+                ('sql_pool_recycle', 'pool_recycle', int),
+                ('sql_pool_pre_ping', 'pool_pre_ping', 'as_bool'))
+
+# {key: (engine, stats)}
+engines = {}
+engines_lock = threading.Lock()
+engines_pid = os.getpid()
+# pools and connections inherited from the parent process. They are never
+# closed so the parent can still use them
+inherited = []
+
+
+def pool_options(config=None):
+    """return the engine options set in the ``[deploy]`` section of the
+    project config, if any: ``sql_pool_size``, ``sql_max_overflow``,
+    ``sql_pool_timeout``, ``sql_pool_recycle`` and ``sql_pool_pre_ping``"""
+    if config is None:
+        for filename in ('buildout.cfg', 'deploy.ini'):
+            if os.path.isfile(filename):
+                config = project_config(filename)
+                break
+        else:
+            return {}
+    options = {}
+    for name, option, convert in POOL_OPTIONS:
+        value = config.deploy[name]
+        if value:
+            if convert == 'as_bool':
+                options[option] = value.as_bool()
+            else:
+                options[option] = convert(value)
+    return options
+
+
+def watch_pool(engine, stats):
+    """count checkouts in stats and discard the connections opened by
+    another process so a pool inherited through fork() is never shared"""
+    from sqlalchemy import event
+    from sqlalchemy import exc
+    lock = threading.Lock()
+
+    def connect(dbapi_connection, record):
+        record.info['pid'] = os.getpid()
+        with lock:
+            stats['connects'] += 1
+
+    def checkout(dbapi_connection, record, proxy):
+        if record.info.get('pid') != os.getpid():
+            inherited.append(dbapi_connection)
+            record.connection = proxy.connection = None
+            with lock:
+                stats['discarded'] += 1
+            raise exc.DisconnectionError(
+                'Connection opened by process %s' % record.info.get('pid'))
+        with lock:
+            stats['checkouts'] += 1
+            stats['checked_out'] += 1
+            stats['max_checked_out'] = max(stats['max_checked_out'],
+                                           stats['checked_out'])
+
+    def checkin(dbapi_connection, record):
+        with lock:
+            stats['checked_out'] = max(stats['checked_out'] - 1, 0)
+
+    event.listen(engine, 'connect', connect)
+    event.listen(engine, 'checkout', checkout)
+    event.listen(engine, 'checkin', checkin)
+
+
+def after_fork():
+    """give each engine an empty pool. The connections of the parent are not
+    closed. Called on the first use of :func:`engine_from_config` in a
+    forked process. Can be used in a gunicorn ``post_fork`` hook"""
+    global engines_pid
+    with engines_lock:
+        if engines_pid == os.getpid():
+            return
+        engines_pid = os.getpid()
+        for engine, stats in engines.values():
+            inherited.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+            stats['checked_out'] = 0
 
 
 def engine_from_config(config, **params):
+    """return an engine for the ``sqlalchemy.`` options of config. Engines
+    are shared: the same engine is returned for the same url and options.
+    Pools use the options of :func:`pool_options` unless they are set in
+    config or params"""
+    import sqlalchemy
     sql_url = get_sql_url()
-    prefix = params.get('prefix', 'sqlalchemy.')
+    prefix = params.pop('prefix', 'sqlalchemy.')
     if sql_url:
         config['%surl' % prefix] = sql_url
-    if config:
-        import sqlalchemy
-        return sqlalchemy.engine_from_config(config, **params)
-    raise RuntimeError('SQLAlchemy configuration dict is empty')
+    if not config:
+        raise RuntimeError('SQLAlchemy configuration dict is empty')
+    options = dict([(k[len(prefix):], v) for k, v in config.items()
+                    if k.startswith(prefix)])
+    options.update(params)
+    if 'url' not in options:
+        raise RuntimeError('No url in SQLAlchemy configuration')
+    if not str(options['url']).startswith('sqlite'):
+        # sqlite pools have no size
+        options = dict(pool_options(), **options)
+    pre_ping = options.get('pool_pre_ping')
+    if isinstance(pre_ping, basestring):
+        options['pool_pre_ping'] = pre_ping.lower() in ('true', 'yes', 'on',
+                                                        '1')
+    key = repr(sorted(options.items()))
+    if engines_pid != os.getpid():
+        after_fork()
+    with engines_lock:
+        if key not in engines:
+            url = options.pop('url')
+            engine = sqlalchemy.create_engine(url, _coerce_config=True,
+                                              **options)
+            stats = dict(checkouts=0, checked_out=0, max_checked_out=0,
+                         connects=0, discarded=0)
+            watch_pool(engine, stats)
+            engines[key] = (engine, stats)
+        return engines[key][0]
+
+
+def pool_stats():
+    """return the checkout statistics and the pool state of each engine"""
+    results = []
+    with engines_lock:
+        for engine, stats in engines.values():
+            pool = engine.pool
+            result = dict(stats, url=repr(engine.url), pool=pool.status())
+            for name in ('size', 'checkedin', 'overflow'):
+                if hasattr(pool, name):
+                    result[name] = getattr(pool, name)()
+            results.append(result)
+    return results
+
+
+def dispose_engines():
+    """close the connections of all engines and forget them"""
+    with engines_lock:
+        for engine, stats in engines.values():
+            engine.dispose()
+        engines.clear()
 
 
 def engine_dict():
-    engine = engine_from_config({})
-    url = engine.url
+    """return the fields of the database url"""
+    sql_url = get_sql_url()
+    if not sql_url:
+        raise RuntimeError('SQLAlchemy configuration dict is empty')
+    from sqlalchemy.engine.url import make_url
+    url = make_url(sql_url)
     return dict(
         database=url.database,
         drivername=url.drivername,
         username=url.username,
         password=url.password,
         host=url.host,
+        port=url.port,
       )
 
 
-def backup_db(backup_dir, dry_run=False):
-    from datetime import datetime
-    now = datetime.now().strftime('%Y%m%d%H%M')
-    data = engine_dict()
-    filename = '%(database)s-%(now)s.sql.gz' % dict(data, now=now)
-    data['filename'] = os.path.join(
-            realpath(os.path.expanduser('~'), 'backups', 'sql'),
-            filename)
-    if data.get('drivername') == 'mysql':
-        log.info('Backuping to %(filename)s', data)
-        cmd = ('mysqldump --add-drop-table %(database)s '
-               '-u %(username)s -p%(password)s '
-               '-h %(host)s | gzip > %(filename)s') % data
-        subprocess.call(cmd, shell=True)
-    elif data.get('drivername').startswith('postgresql'):
-        log.info('Backuping to %(filename)s', data)
-        cmd = ('pg_dump -c -w -U %(username)s '
-               '%(database)s | gzip > %(filename)s') % data
-        subprocess.call(cmd, shell=True)
+def backup_db(backup_dir=None, dry_run=False, parallel=False, jobs=None,
+              incremental=False):
+    """dump the database to ``~/backups/sql`` or backup_dir. See
+    :mod:`pytheon.backup`"""
+    from pytheon import backup
+    try:
+        return backup.backup_db(backup_dir, dry_run=dry_run,
+                                parallel=parallel, jobs=jobs,
+                                incremental=incremental)
+    except backup.BackupError, e:
+        log.error('Backup failed: %s', e)
+        sys.exit(1)
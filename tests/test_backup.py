@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+from testing import *
+from distutils.spawn import find_executable
+from pytheon import backup
+from pytheon import store
+from datetime import datetime, timedelta
+from StringIO import StringIO
+import gzip
+import threading
+import hashlib
+import sys
+
+DATA = ''.join(['INSERT INTO t VALUES (%s);\n' % i for i in range(50000)])
+
+
+class TestBackup(TestCase):
+
+    def dump_args(self, status=0):
+        code = ('import sys; sys.stdout.write(open(%r).read()); '
+                'sys.stderr.write("dump error"); sys.exit(%s)' % (
+                    self.source, status))
+        return [sys.executable, '-c', code]
+
+    def setUp(self):
+        TestCase.setUp(self)
+        # outside of self.wd which must only contain the backups
+        self.source = self.writeFile(DATA, self.home, 'source.sql')
+
+    def test_dump_zlib(self):
+        filename = join(self.wd, 'db.sql.gz')
+        stats = backup.dump(self.dump_args(), filename,
+                            backup.get_compressor('gzip'))
+        self.assertEqual(stats['raw'], len(DATA))
+        self.assertTrue(stats['size'] < len(DATA) / 4)
+        self.assertEqual(gzip.open(filename).read(), DATA)
+        self.assertEqual(os.stat(filename).st_mode & 0777, 0600)
+        self.assertEqual(os.listdir(self.wd), ['db.sql.gz'])
+
+    def test_dump_program(self):
+        if not find_executable('zstd'):
+            self.skipTest('zstd is not installed')
+        compressor = backup.get_compressor('zstd')
+        self.assertEqual(compressor.extension, '.zst')
+        filename = join(self.wd, 'db.sql.zst')
+        backup.dump(self.dump_args(), filename, compressor)
+        p = subprocess.Popen(['zstd', '-dc', filename],
+                             stdout=subprocess.PIPE)
+        self.assertEqual(p.communicate()[0], DATA)
+
+    def test_missing_program(self):
+        backup.COMPRESSORS['missing'] = ('.x', ['pytheon-missing-program'])
+        self.addCleanup(backup.COMPRESSORS.pop, 'missing')
+        self.assertEqual(backup.get_compressor('missing').name, 'gzip')
+        self.assertRaises(backup.BackupError, backup.get_compressor, 'rar')
+
+    def test_dump_failure(self):
+        filename = join(self.wd, 'db.sql.gz')
+        try:
+            backup.dump(self.dump_args(status=2), filename,
+                        backup.get_compressor('gzip'))
+        except backup.BackupError, e:
+            self.assertIn('status 2: dump error', str(e))
+        else:
+            self.fail('BackupError not raised')
+        self.assertEqual(os.listdir(self.wd), [])
+
+    def test_compressor_failure(self):
+        compressor = backup.Compressor('false', '.gz', ['false'])
+        self.assertRaises(backup.BackupError, backup.dump, self.dump_args(),
+                          join(self.wd, 'db.sql.gz'), compressor)
+        self.assertEqual(os.listdir(self.wd), [])
+
+    def test_dump_command(self):
+        data = dict(drivername='mysql', username='user', password='p"ss',
+                    host='127.0.0.1', port=3306, database='db')
+        defaults = backup.mysql_defaults(data)
+        self.addCleanup(os.remove, defaults)
+        args, env = backup.dump_command(data, defaults)
+        self.assertEqual(args, ['mysqldump',
+                                '--defaults-extra-file=%s' % defaults,
+                                '--add-drop-table', '-u', 'user',
+                                '-h', '127.0.0.1', '-P', '3306', 'db'])
+        self.assertEqual(open(defaults).read(),
+                         '[client]\npassword="p\\"ss"\n')
+        data['drivername'] = 'postgresql'
+        args, env = backup.dump_command(data)
+        self.assertEqual(args, ['pg_dump', '-c', '-w', '-U', 'user', 'db'])
+        self.assertEqual(env['PGPASSWORD'], 'p"ss')
+        data['drivername'] = 'sqlite'
+        self.assertRaises(backup.BackupError, backup.dump_command, data)
+
+    def test_dump_parallel(self):
+        commands = [(name, self.dump_args(), None)
+                    for name in ('users', 'apps', 'addons')]
+        entries = backup.dump_parallel(commands, self.wd,
+                                       backup.get_compressor('gzip'), 2)
+        self.assertEqual([e['name'] for e in entries],
+                         ['addons', 'apps', 'users'])
+        entry = entries[0]
+        self.assertEqual(entry['file'], 'addons.sql.gz')
+        self.assertEqual(entry['raw'], len(DATA))
+        self.assertEqual(entry['sha256'], hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(entry['file_sha256'], hashlib.sha256(
+                            open(join(self.wd, entry['file'])).read()).hexdigest())
+        commands.append(('broken', self.dump_args(status=1), None))
+        self.assertRaises(backup.BackupError, backup.dump_parallel, commands,
+                          self.wd, backup.get_compressor('gzip'), 2)
+
+    def test_table_commands(self):
+        data = dict(drivername='postgresql', username='user', password=None,
+                    host='127.0.0.1', port=5432, database='db')
+        commands = backup.table_commands(data, ['users'], snapshot='0-1')
+        self.assertEqual([(n, a) for n, a, e in commands], [
+            ('_schema', ['pg_dump', '-c', '-w', '-U', 'user',
+                         '--snapshot=0-1', '-s', 'db']),
+            ('users', ['pg_dump', '-w', '-U', 'user',
+                       '--snapshot=0-1', '-a', '-t', '"users"', 'db'])])
+        data['drivername'] = 'mysql'
+        commands = backup.table_commands(data, ['users'], 'my.cnf')
+        self.assertEqual(commands[0][1][-4:],
+                         ['5432', '--single-transaction', 'db', 'users'])
+
+    def test_backup_tables_keeps_shared_pool(self):
+        from pytheon import utils
+        self.addCleanup(os.environ.pop, 'SQLITE_URL', None)
+        os.environ['SQLITE_URL'] = 'sqlite:///%s' % join(self.home, 'db')
+        self.addCleanup(utils.dispose_engines)
+        engine = utils.engine_from_config({})
+        engine.execute('CREATE TABLE users (id INTEGER)')
+        pool = engine.pool
+        data = utils.engine_dict()
+        self.assertRaises(backup.BackupError, backup.backup_tables, data,
+                          join(self.wd, 'db'), backup.get_compressor('gzip'))
+        self.assertTrue(engine.pool is pool)
+
+    def test_prune_files(self):
+        for name in ('db-201201010000.sql.gz', 'db-201201020000.sql.gz',
+                     'db-201201020100.sql.gz', 'other-201201010000.sql.gz',
+                     'db-notes.txt'):
+            self.writeFile('', self.wd, name)
+        os.mkdir(join(self.wd, 'db-201201030000'))
+        self.assertEqual(backup.prune_files(self.wd, 'db', daily=2),
+                         ['db-201201020000.sql.gz', 'db-201201010000.sql.gz'])
+        self.assertEqual(sorted(os.listdir(self.wd)),
+                         ['db-201201020100.sql.gz', 'db-201201030000',
+                          'db-notes.txt', 'other-201201010000.sql.gz'])
+
+    def test_prune_shared_prefix(self):
+        names = ['app-201201010000.sql.gz', 'app-201201020000.sql.gz',
+                 'app-old-201201030000.sql.gz', 'app-old-201201040000.sql.gz']
+        for name in names:
+            self.writeFile('', self.wd, name)
+        self.assertEqual(backup.prune_files(self.wd, 'app', daily=1),
+                         ['app-201201010000.sql.gz'])
+        self.assertEqual(backup.prune_files(self.wd, 'app-old', daily=1),
+                         ['app-old-201201030000.sql.gz'])
+        self.assertEqual(sorted(os.listdir(self.wd)),
+                         [names[1], names[3]])
+        repository = store.ChunkStore(join(self.wd, 'store'))
+        for name in names:
+            repository.save(name.split('.')[0],
+                            dict(chunks=[], size=0, sha256=''))
+        self.assertEqual(repository.prune('app', daily=1),
+                         ['app-201201010000'])
+        self.assertEqual(repository.backups(), ['app-201201020000',
+                         'app-old-201201030000', 'app-old-201201040000'])
+
+
+class TestStore(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = store.ChunkStore(join(self.wd, 'store'), min_size=4096,
+                                      max_size=65536, mask=0x7)
+
+    def backup(self, name, data):
+        manifest = self.store.backup(StringIO(data), jobs=3)
+        self.store.save(name, manifest)
+        return manifest
+
+    def restore(self, name):
+        out = StringIO()
+        self.store.restore(name, out, jobs=3)
+        return out.getvalue()
+
+    def test_split(self):
+        chunks = list(store.split(StringIO(DATA).read, 4096, 65536, 0x7))
+        self.assertEqual(''.join(chunks), DATA)
+        self.assertTrue(len(chunks) > 10)
+        self.assertTrue(max([len(c) for c in chunks]) <= 65536)
+        # cuts do not depend on the position in the stream
+        changed = 'CREATE TABLE t;\n' + DATA
+        other = list(store.split(StringIO(changed).read, 4096, 65536, 0x7))
+        self.assertTrue(len(set(chunks) & set(other)) >= len(chunks) - 2)
+        data = 'x' * 100000
+        chunks = list(store.split(StringIO(data).read, 4096, 65536, 0x7))
+        self.assertEqual([len(c) for c in chunks], [65536, 34464])
+
+    def test_split_max_size(self):
+        # lines longer than a chunk after lines which are not cut
+        data = 'a\n' * 20000 + 'x' * 100000 + '\nb\n' + 'y' * 70000
+        for read_size in (store.READ_SIZE, 30000):
+            read = lambda size, fd=StringIO(data): fd.read(read_size)
+            chunks = list(store.split(read, 4096, 65536, 0xffffff))
+            self.assertEqual(''.join(chunks), data)
+            self.assertTrue(max([len(c) for c in chunks]) <= 65536)
+
+    def test_incremental(self):
+        manifest = self.backup('db-201201010000', DATA)
+        self.assertEqual(manifest['size'], len(DATA))
+        self.assertEqual(manifest['sha256'], hashlib.sha256(DATA).hexdigest())
+        lines = DATA.splitlines(True)
+        lines.insert(25000, 'DELETE FROM t;\n')
+        changed = ''.join(lines)
+        second = self.backup('db-201201020000', changed)
+        self.assertTrue(0 < second['written'] < manifest['written'] / 5)
+        self.assertEqual(self.restore('db-201201010000'), DATA)
+        self.assertEqual(self.restore('db-201201020000'), changed)
+        self.assertEqual(self.store.backups(),
+                         ['db-201201010000', 'db-201201020000'])
+        self.assertEqual(self.store.verify('db-201201020000'), [])
+
+    def test_corruption(self):
+        manifest = self.backup('db-201201010000', DATA)
+        key = manifest['chunks'][3][0]
+        self.writeFile('garbage', self.store.chunk_path(key))
+        errors = self.store.verify('db-201201010000')
+        self.assertEqual(len(errors), 1)
+        self.assertIn(key, errors[0])
+        self.assertRaises(store.StoreError, self.restore, 'db-201201010000')
+        self.assertRaises(store.StoreError, self.store.verify, 'missing')
+
+    def test_expired(self):
+        dates = dict([('db-%s' % i,
+                       datetime(2012, 1, 1) + timedelta(hours=12 * i))
+                      for i in range(398)])
+        kept = set(dates) - set(store.expired(dates, daily=3, weekly=2,
+                                              monthly=2))
+        # the last backup of july 15, 16 and 17, of the week starting on
+        # july 9 and of june
+        self.assertEqual(sorted(kept, key=lambda n: dates[n]),
+                         ['db-363', 'db-393', 'db-395', 'db-397'])
+        self.assertEqual(store.expired(dates), sorted(
+                            dates, key=lambda n: dates[n], reverse=True))
+
+    def test_prune(self):
+        self.backup('db-201201010000', DATA)
+        self.backup('db-201201020000', DATA[:100000] + 'UPDATE t;\n')
+        self.backup('other-201201010000', 'SELECT 1;\n')
+        self.assertEqual(self.store.prune('db', daily=1),
+                         ['db-201201010000'])
+        self.assertEqual(self.store.backups(),
+                         ['db-201201020000', 'other-201201010000'])
+        self.assertEqual(self.restore('db-201201020000'),
+                         DATA[:100000] + 'UPDATE t;\n')
+        self.assertEqual(self.store.collect(), 0)
+        root = join(self.store.directory, 'chunks')
+        stored = sum([len(os.listdir(join(root, d)))
+                      for d in os.listdir(root)])
+        used = set([k for n in self.store.backups()
+                    for k, s in self.store.manifest(n)['chunks']])
+        self.assertEqual(stored, len(used))
+
+    def test_collect_waits_for_backups(self):
+        manifest = self.store.backup(StringIO(DATA))
+        removed = []
+        thread = threading.Thread(
+                    target=lambda: removed.append(self.store.collect()))
+        thread.start()
+        thread.join(.2)
+        self.assertTrue(thread.isAlive())
+        self.store.save('db-201201010000', manifest)
+        thread.join()
+        self.assertEqual(removed, [0])
+        self.assertEqual(self.restore('db-201201010000'), DATA)
+
+    def test_dump_to_store(self):
+        source = self.writeFile(DATA, self.home, 'source.sql')
+        args = [sys.executable, '-c',
+                'import sys; sys.stdout.write(open(%r).read())' % source]
+        manifest = backup.dump_to_store(args, self.store, 'db-201201010000',
+                                        database='db')
+        self.assertEqual(self.store.manifest('db-201201010000')['database'],
+                         'db')
+        self.assertEqual(self.restore('db-201201010000'), DATA)
+        args[-1] += '; sys.exit(3)'
+        self.assertRaises(backup.BackupError, backup.dump_to_store, args,
+                          self.store, 'db-201201020000')
+        self.assertEqual(self.store.backups(), ['db-201201010000'])
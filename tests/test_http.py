@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+from testing import *
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from pytheon import http
+from pytheon import utils
+from pytheon import cache
+from pytheon import trace
+import threading
+import httplib
+import socket
+import errno
+import time
+import ssl
+import zlib
+import json
+from urllib import urlencode
+
+
+def content_type(body):
+    if body.strip()[:1] in ('[', '{'):
+        return 'application/json'
+    return 'text/plain'
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+        time.sleep(self.server.delay)
+        if self.path in self.server.chunks:
+            return self.send_chunks(self.server.chunks[self.path])
+        body = self.server.responses.get(self.path, 'ok %s' % self.path)
+        if self.server.errors:
+            status = self.server.errors.pop(0)
+            body = self.server.error_bodies.get(status, '')
+            self.send_response(status)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Type', content_type(body))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        etag = self.server.headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        headers = dict(self.server.headers)
+        headers.update(self.server.links.get(self.path, {}))
+        headers['Content-Type'] = content_type(body)
+        if self.server.compress and \
+           'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = http.gzip_body(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(200)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_DELETE = do_GET
+
+    def send_chunks(self, chunks):
+        self.send_response(200)
+        for k, v in self.server.headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', content_type(''.join(chunks)))
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks + ['']:
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+
+    def do_POST(self):
+        if self.headers.get('Expect') == '100-continue':
+            if self.server.reject:
+                self.server.requests.append((self.command, self.path))
+                self.send_response(self.server.reject)
+                self.send_header('Content-Length', '0')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = 1
+                return
+            if not self.server.ignore_expect:
+                self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.bodies.append(self.rfile.read(length))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.requests = []
+        self.bodies = []
+        self.responses = {}
+        self.delay = 0
+        self.headers = {}
+        self.compress = False
+        self.chunks = {}
+        self.errors = []
+        self.error_bodies = {}
+        self.reject = None
+        self.ignore_expect = False
+        self.links = {}
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        return ThreadingMixIn.process_request(self, request, client_address)
+
+
+class BrokenConnection(object):
+    """a pooled connection failing with error"""
+
+    def __init__(self, error, sending=True):
+        self.sock, self.peer = socket.socketpair()
+        self.error = error
+        self.sending = sending
+        self.host, self.port = '127.0.0.1', 0
+
+    def request(self, *args):
+        if self.sending:
+            raise self.error
+
+    def getresponse(self):
+        raise self.error
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class Keyring(object):
+
+    def __init__(self):
+        self.passwords = {}
+        self.calls = []
+
+    def get_password(self, service, username):
+        self.calls.append(('get', service))
+        return self.passwords.get((service, username))
+
+    def set_password(self, service, username, password):
+        self.calls.append(('set', service))
+        self.passwords[(service, username)] = password
+
+
+class TestHttp(TestCase):
+
+    handler = Handler
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.server = Server(('127.0.0.1', 0), self.handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(http.pool.clear)
+        self.host = '127.0.0.1:%s' % self.server.server_address[1]
+
+    def request(self, path, **kwargs):
+        kwargs.setdefault('auth', False)
+        return http.request(path, host=self.host, **kwargs)
+
+    def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(self.request('/v1/%s' % i), 'ok /v1/%s' % i)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_stale_connection(self):
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        for conn, last_used in http.pool.connections[self.host]:
+            conn.sock.close()
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_replay_on_stale_connection(self):
+        for error in (socket.error(errno.EPIPE, 'Broken pipe'),
+                      httplib.BadStatusLine("''")):
+            http.pool.put(self.host, BrokenConnection(error,
+                              sending=isinstance(error, socket.error)))
+            conn, resp = http.send(self.host, 'GET', '/v1/addons', None, {})
+            self.assertEqual(resp.read(), 'ok /v1/addons')
+            http.release(self.host, conn, resp)
+            http.pool.clear()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_no_replay_once_sent(self):
+        errors = [(socket.timeout('timed out'), True),
+                  (socket.error(errno.ECONNRESET, 'Reset'), False),
+                  (httplib.BadStatusLine('HTTP/1.1 bogus'), False)]
+        for error, sending in errors:
+            http.pool.put(self.host, BrokenConnection(error, sending))
+            self.assertRaises(error.__class__, http.send, self.host, 'POST',
+                              '/v1/applications', 'name=app', {})
+        self.assertEqual(self.server.requests, [])
+
+    def test_pool_size(self):
+        pool = http.ConnectionPool(size=0)
+        self.assertEqual(pool.size, 0)
+        conn = BrokenConnection(None)
+        pool.put(self.host, conn)
+        self.assertEqual(pool.connections[self.host], [])
+
+    def test_idle_timeout(self):
+        self.writeFile('''
+[pytheon]
+pool_idle_timeout = 0
+''', self.home, '.pytheonrc')
+        self.request('/v1/addons')
+        self.request('/v1/addons')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_request_many(self):
+        paths = ['/v1/%s' % i for i in range(10)]
+        results = http.request_many(paths, concurrency=3,
+                                    auth=False, host=self.host)
+        self.assertEqual(results, ['ok %s' % p for p in paths])
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertTrue(self.server.connections <= 3)
+
+    def test_request_async(self):
+        done = []
+        future = http.request_async('/v1/addons', callback=done.append,
+                                    auth=False, host=self.host)
+        self.assertEqual(future.result(5), 'ok /v1/addons')
+        self.assertEqual(done, [future])
+        self.assertFalse(future.cancel())
+
+    def test_request_async_timeout(self):
+        self.writeFile('''
+[pytheon]
+retries = 0
+''', self.home, '.pytheonrc')
+        self.server.delay = .5
+        future = http.request_async('/v1/addons', auth=False,
+                                    host=self.host, timeout=.1)
+        self.assertTrue(isinstance(future.exception(5), OSError))
+        future = http.request_async('/v1/addons', auth=False,
+                                    host=self.host)
+        self.assertRaises(http.Timeout, future.result, .1)
+
+    def test_cache_revalidation(self):
+        self.server.headers['ETag'] = '"v1"'
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.server.responses['/v1/addons'] = 'changed'
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.request('/v1/addons', use_cache=False),
+                         'changed')
+
+    def test_cache_max_age(self):
+        self.server.headers['Cache-Control'] = 'max-age=60'
+        self.request('/v1/applications')
+        self.request('/v1/applications')
+        self.assertEqual(len(self.server.requests), 1)
+        # a DELETE invalidate the listing
+        self.request('/v1/applications/app1', method='DELETE')
+        self.request('/v1/applications')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_cache_eviction(self):
+        responses = cache.ResponseCache(join(self.home, 'cache'), 150)
+        for i in range(3):
+            responses.store(str(i), cache.Entry('/%s' % i, [], 'x' * 50))
+        self.assertEqual(responses.get('0'), None)
+        self.assertEqual(responses.get('2').body, 'x' * 50)
+
+    def test_cache_invalidation(self):
+        responses = cache.ResponseCache(join(self.home, 'cache'))
+        paths = ['/v1/applications', '/v1/applications?limit=10',
+                 '/v1/applications1', '/v1/applications12',
+                 '/v1/applications1/addons']
+        for path in paths:
+            responses.store(responses.key(path), cache.Entry(path, [], ''))
+
+        def cached():
+            return [p for p in paths if responses.get(responses.key(p))]
+
+        responses.invalidate('/v1/applications1')
+        self.assertEqual(cached(), ['/v1/applications',
+                                    '/v1/applications?limit=10',
+                                    '/v1/applications12'])
+        responses.invalidate('/v1/applications/app1')
+        self.assertEqual(cached(), ['/v1/applications12'])
+
+    def test_cache_is_private(self):
+        directory = join(self.home, 'cache')
+        responses = cache.ResponseCache(directory)
+        responses.store('key', cache.Entry('/v1/account', [], 'secret'))
+        self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+        self.assertEqual(os.stat(responses.filename('key')).st_mode & 0777,
+                         0600)
+
+    def test_compression(self):
+        self.server.compress = True
+        body = 'x' * 100000
+        self.server.responses['/v1/applications'] = body
+        stats = dict(http.transfer_stats)
+        self.assertEqual(self.request('/v1/applications'), body)
+        received = http.transfer_stats['received'] - stats['received']
+        wire = http.transfer_stats['received_wire'] - stats['received_wire']
+        self.assertEqual(received, 100000)
+        self.assertTrue(wire < 1000)
+
+    def test_compressed_post(self):
+        raw_data = 'ssh-rsa ' + 'x' * 5000
+        self.request('/v1/account/keys', raw_data=raw_data, compress=True)
+        body = zlib.decompress(self.server.bodies[0], 16 + zlib.MAX_WBITS)
+        self.assertEqual(body, urlencode(dict(raw_data=raw_data)))
+
+    def test_stream(self):
+        self.server.chunks['/v1/logs'] = ['building\nins', 'talling\n', 'done']
+        lines = self.request('/v1/logs', stream=True)
+        self.assertEqual(lines.next(), 'building\n')
+        self.assertEqual(list(lines), ['installing\n', 'done'])
+        # the connection was released and is reused
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_stream_closed(self):
+        self.server.chunks['/v1/logs'] = ['building\n', 'done']
+        for read in (0, 1):
+            lines = self.request('/v1/logs', stream=True)
+            conn = lines.conn
+            for i in range(read):
+                lines.next()
+            lines.close()
+            self.assertEqual(conn.sock, None)
+            self.assertEqual(http.pool.connections.get(self.host, []), [])
+        self.server.chunks['/v1/logs'] = ['[1, ', '2]']
+        apps = http.iter_json('/v1/logs', host=self.host, auth=False,
+                              use_cache=False)
+        self.assertEqual(apps.next(), 1)
+        apps.close()
+        self.assertEqual(http.pool.connections.get(self.host, []), [])
+
+    def test_iter_json(self):
+        self.server.chunks['/v1/applications'] = [
+            ' [{"name": "app1", "addons": ["mysql"]},',
+            '{"name": "ap', 'p2", "size": 12', '3}, 42', ', [1]]']
+        apps = http.iter_json('/v1/applications', host=self.host, auth=False)
+        app = apps.next()
+        self.assertEqual(app.name, 'app1')
+        self.assertEqual(app.addons, ['mysql'])
+        self.assertEqual(list(apps), [{'name': 'app2', 'size': 123}, 42, [1]])
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_iter_json_errors(self):
+        self.server.errors = [404]
+        self.server.error_bodies[404] = '{"error": "Not found"}'
+        apps = http.iter_json('/v1/applications', host=self.host, auth=False)
+        self.assertEqual(list(apps), [])
+        self.server.chunks['/v1/applications'] = ['Not ', 'JSON']
+        apps = http.iter_json('/v1/applications', host=self.host, auth=False)
+        self.assertEqual(list(apps), [])
+
+    def test_iter_json_cached(self):
+        self.server.headers['Cache-Control'] = 'max-age=60'
+        self.server.chunks['/v1/applications'] = ['[{"name": "app1"}', ']']
+        for i in range(2):
+            apps = http.iter_json('/v1/applications', host=self.host,
+                                  auth=False)
+            self.assertEqual([app.name for app in apps], ['app1'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_iter_json_array(self):
+        self.assertEqual(list(http.iter_json_array(['[', ']'])), [])
+        self.assertEqual(list(http.iter_json_array(['{"a"', ': 1}'])),
+                         [{'a': 1}])
+        self.assertEqual(list(http.iter_json_array(['[1, 2', '.5, "a"]'])),
+                         [1, 2.5, 'a'])
+        self.assertRaises(ValueError, list, http.iter_json_array(['[1, {']))
+
+    def test_iter_listing(self):
+        self.server.responses['/v1/applications?limit=5'] = '- app1\n- app2\n'
+        self.server.links['/v1/applications?limit=5'] = {
+            'Link': '<http://%s/v1/applications?page=2>; rel="next"' % self.host}
+        self.server.responses['/v1/applications?page=2'] = '- app3\n'
+        self.server.links['/v1/applications?page=2'] = {
+            'X-Next-Cursor': 'abc'}
+        self.server.responses['/v1/applications?page=2&cursor=abc'] = \
+            '- app4\n- app5\n- app6\n'
+        apps = http.iter_listing('/v1/applications', limit=5,
+                                 host=self.host, auth=False)
+        self.assertEqual(list(apps), ['- app1\n', '- app2\n', '- app3\n',
+                                      '- app4\n', '- app5\n'])
+        self.assertEqual([p for m, p in self.server.requests],
+                         ['/v1/applications?limit=5',
+                          '/v1/applications?page=2',
+                          '/v1/applications?page=2&cursor=abc'])
+
+    def test_iter_listing_json(self):
+        path = '/v1/applications?fields=name%2Caddons'
+        self.server.responses[path] = '[{"name": "app1", "addons": []}]'
+        self.server.links[path] = {'Link': '</v1/applications?p=2>; rel=next'}
+        self.server.responses['/v1/applications?p=2'] = '[{"name": "app2"}]'
+        apps = http.iter_listing('/v1/applications', fields=['name', 'addons'],
+                                 json=True, host=self.host, auth=False)
+        self.assertEqual([a.name for a in apps], ['app1', 'app2'])
+
+    def test_next_page(self):
+        self.assertEqual(http.next_page([], '/v1/apps'), None)
+        self.assertEqual(http.next_page(
+            [('Link', '</v1/apps?p=1>; rel="prev", </v1/apps?p=3>; rel="next"')],
+            '/v1/apps?p=2'), '/v1/apps?p=3')
+        self.assertEqual(http.next_page([('X-Next-Cursor', 'x y')],
+                                        '/v1/apps?limit=2&cursor=a'),
+                         '/v1/apps?limit=2&cursor=x+y')
+
+    def test_retry(self):
+        self.server.errors = [503, 502]
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_retry_for_post(self):
+        self.server.errors = [503]
+        self.request('/v1/applications', method='POST', name='app')
+        self.assertEqual(self.server.requests, [('POST', '/v1/applications')])
+
+    def test_circuit_breaker(self):
+        self.writeFile('''
+[pytheon]
+retries = 0
+breaker_threshold = 2
+''', self.home, '.pytheonrc')
+        self.server.errors = [503, 503]
+        self.request('/v1/addons')
+        self.request('/v1/addons')
+        self.assertRaises(http.CircuitOpenError, self.request, '/v1/addons')
+        self.assertEqual(len(self.server.requests), 2)
+        http.breaker.success(self.host)
+        self.assertEqual(self.request('/v1/addons'), 'ok /v1/addons')
+
+    def test_trace_hooks(self):
+        spans = []
+        trace.hooks.append(spans.append)
+        self.addCleanup(trace.hooks.remove, spans.append)
+        self.request('/v1/addons')
+        names = [s.name for s in spans]
+        self.assertEqual(names,
+                         ['dns', 'tcp', 'send', 'ttfb', 'read', 'request'])
+        request = spans[-1]
+        self.assertEqual(request.args['path'], '/v1/addons')
+        self.assertEqual(request.args['status'], 200)
+        self.assertEqual(request.children, spans[:-1])
+
+    def test_trace_file(self):
+        from pytheon.main import run
+        self.writeFile('''
+[pytheon]
+api_host = %s
+auth_cookie = secret
+''' % self.host, self.home, '.pytheonrc')
+        filename = join(self.wd, 'trace.json')
+        run('--trace', filename, 'apps', '--addons')
+        events = json.load(open(filename))['traceEvents']
+        self.assertEqual(len([e for e in events if e['name'] == 'request']),
+                         1)
+        self.assertFalse(trace.enabled)
+        self.assertEqual(trace.spans, [])
+
+    def test_credentials_cache(self):
+        self.writeFile('''
+[pytheon]
+username = user@example.com
+''', self.home, '.pytheonrc')
+        backend = Keyring()
+        backend.passwords[('cookie:api.pytheon.net', 'user@example.com')] = \
+            'secret'
+        self.addCleanup(setattr, http, 'keyring', http.keyring)
+        self.addCleanup(http.credentials.clear)
+        http.keyring = backend
+        self.server.headers['Set-Cookie'] = 'auth_tkt=secret; Path=/'
+        for i in range(3):
+            self.request('/v1/addons', auth=True)
+        self.assertEqual(backend.calls, [('get', 'cookie:api.pytheon.net')])
+        self.server.headers['Set-Cookie'] = 'auth_tkt=new; Path=/'
+        self.request('/v1/addons', auth=True)
+        self.request('/v1/addons', auth=True)
+        self.assertEqual(backend.calls[1:], [('set', 'cookie:api.pytheon.net')])
+
+    def test_expired_cookie(self):
+        self.writeFile('''
+[pytheon]
+username = user@example.com
+auth_cookie = secret
+''', self.home, '.pytheonrc')
+        self.server.headers['Set-Cookie'] = 'auth_tkt=secret; Max-Age=30'
+        self.request('/v1/addons', auth=True)
+        config = utils.user_config()
+        self.assertTrue(config.pytheon.auth_cookie_expires)
+        self.assertTrue(http.cookie_expired(config))
+        # the cookie is about to expire. Basic auth will be used
+        self.assertEqual(http.auth_cookie(), None)
+
+    def test_refresh_session(self):
+        self.writeFile('''
+[pytheon]
+api_host = %s
+username = user@example.com
+auth_cookie = old
+''' % self.host, self.home, '.pytheonrc')
+        backend = Keyring()
+        backend.passwords[('basic:api.pytheon.net', 'user@example.com')] = \
+            'passwd'
+        self.addCleanup(setattr, http, 'keyring', http.keyring)
+        self.addCleanup(http.credentials.clear)
+        http.keyring = backend
+        self.server.headers['Set-Cookie'] = 'auth_tkt=new; Max-Age=3600'
+        self.assertTrue(http.refresh_session())
+        self.assertEqual(
+            backend.passwords[('cookie:api.pytheon.net', 'user@example.com')],
+            'new')
+        config = utils.user_config()
+        self.assertFalse(http.cookie_expired(config, http.REFRESH_WINDOW))
+
+    def expiring_session(self, expires=120):
+        """use a session cookie expiring in ``expires`` seconds. The
+        background refresh is disabled"""
+        self.writeFile('''
+[pytheon]
+username = user@example.com
+auth_cookie_expires = %d
+''' % (time.time() + expires), self.home, '.pytheonrc')
+        backend = Keyring()
+        backend.passwords[('cookie:api.pytheon.net', 'user@example.com')] = \
+            'session'
+        self.addCleanup(setattr, http, 'keyring', http.keyring)
+        self.addCleanup(http.credentials.clear)
+        http.keyring = backend
+        http.refresh_lock.acquire()
+        self.addCleanup(http.refresh_lock.release)
+        self.addCleanup(setattr, utils, 'input_hook', None)
+        utils.input_hook = lambda *args: 'passwd'
+        self.addCleanup(http.no_continue.clear)
+
+    def test_expect_continue(self):
+        self.expiring_session()
+        raw_data = 'ssh-rsa ' + 'x' * 5000
+        self.assertEqual(self.request('/v1/account/keys', auth=True,
+                                      raw_data=raw_data),
+                         'ok /v1/account/keys')
+        self.assertEqual(self.server.bodies,
+                         [urlencode(dict(raw_data=raw_data))])
+        # the body is not sent when the cookie is rejected. It's sent again
+        # with basic auth
+        self.server.reject = 401
+        self.request('/v1/account/keys', auth=True, raw_data=raw_data)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.bodies), 2)
+        # small bodies are sent with the headers
+        self.server.reject = None
+        self.request('/v1/applications', auth=True, name='app')
+        self.assertEqual(self.server.bodies[-1], 'name=app')
+
+    def test_expect_valid_session(self):
+        # a cookie far from its expiry may still be rejected
+        self.expiring_session(expires=3600)
+        self.server.reject = 401
+        raw_data = 'ssh-rsa ' + 'x' * 5000
+        self.request('/v1/account/keys', auth=True, raw_data=raw_data)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.server.bodies), 1)
+
+    def test_expect_ignored(self):
+        self.server.ignore_expect = True
+        raw_data = 'ssh-rsa ' + 'x' * 5000
+        # no Expect without a session cookie
+        start = time.time()
+        self.request('/v1/account/keys', raw_data=raw_data)
+        self.assertTrue(time.time() - start < .5)
+        self.expiring_session()
+        self.addCleanup(setattr, http, 'EXPECT_TIMEOUT', http.EXPECT_TIMEOUT)
+        http.EXPECT_TIMEOUT = .3
+        start = time.time()
+        self.request('/v1/account/keys', auth=True, raw_data=raw_data)
+        self.assertTrue(time.time() - start >= .3)
+        self.assertEqual(http.no_continue, set([self.host]))
+        # the host is remembered
+        start = time.time()
+        self.request('/v1/account/keys', auth=True, raw_data=raw_data)
+        self.assertTrue(time.time() - start < .3)
+        self.assertEqual(len(self.server.bodies), 3)
+
+    def test_ssl_context(self):
+        context = http.ssl_context()
+        if context is None:
+            self.skipTest('ssl.SSLContext is not available')
+        self.assertTrue(context is http.ssl_context())
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
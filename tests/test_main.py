@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from testing import *
+from test_http import Server
+from test_http import Handler
+from pytheon.main import run
+from pytheon import http
+import threading
+import sys
+
+
+class TestStartup(TestCase):
+
+    def import_main(self):
+        """return the modules imported by pytheon.main. The import time is
+        measured by benchmarks/run.py (startup_import)"""
+        code = ('import sys; import pytheon.main; '
+                'print " ".join(sorted(sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        p = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE)
+        modules = p.communicate()[0].strip()
+        self.assertEqual(p.returncode, 0)
+        return modules.split()
+
+    def test_lazy_imports(self):
+        modules = self.import_main()
+        for name in ('pytheon.http', 'httplib', 'Cookie', 'keyring'):
+            self.assertNotIn(name, modules)
+
+
+class TestCommands(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(http.pool.clear)
+        self.writeFile('''
+[pytheon]
+api_host = 127.0.0.1:%s
+auth_cookie = secret
+''' % self.server.server_address[1], self.home, '.pytheonrc')
+
+    def test_batch(self):
+        filename = self.writeFile('''
+# list and delete
+apps -l
+["apps", "--delete", "myapp"]
+{"command": "apps", "args": ["-l"]}
+''', self.wd, 'commands.txt')
+        run('batch', filename)
+        self.assertEqual(self.server.requests, [
+            ('GET', '/v1/applications'),
+            ('DELETE', '/v1/applications/myapp'),
+            ('GET', '/v1/applications'),
+        ])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_apps_addons(self):
+        self.server.responses['/v1/applications?fields=name'] = \
+            '[{"name": "app1"}, {"name": "app2"}]'
+        out = run('apps', '--addons', '-j', '2')
+        self.assertIn('[app1]\nok /v1/applications/app1/addons', out)
+        self.assertIn('[app2]\nok /v1/applications/app2/addons', out)
+
+    def test_apps_cached(self):
+        self.server.responses['/v1/applications'] = '- app1\n- app2\n'
+        self.server.headers.update({'Cache-Control': 'max-age=600',
+                                    'ETag': '"v1"'})
+        for i in range(3):
+            self.assertEqual(run('apps', '-l'), '- app1\n- app2')
+        self.assertEqual(self.server.requests,
+                         [('GET', '/v1/applications')])
+        # a listing which was not fully read is not cached
+        self.server.responses['/v1/addons'] = '- mysql\n- redis\n'
+        for i in range(2):
+            lines = http.request('/v1/addons', stream=True)
+            self.assertEqual(lines.next(), '- mysql\n')
+            lines.close()
+        self.assertEqual(self.server.requests[1:],
+                         [('GET', '/v1/addons')] * 2)
+
+    def test_apps_fields(self):
+        path = '/v1/applications?fields=name%2Caddons&limit=1'
+        self.server.responses[path] = \
+            '[{"name": "app1", "addons": ["mysql", "redis"]}, {"name": "x"}]'
+        out = run('apps', '-l', '--fields', 'name,addons', '--limit', '1')
+        self.assertEqual(out, 'app1\tmysql,redis')
+
+    def test_agent(self):
+        from pytheon import agent
+        from cStringIO import StringIO
+        path = join(self.home, '.pytheon', 'agent.sock')
+        self.assertEqual(agent.forward(['apps', '-l'], path), None)
+        server = agent.Agent(path, idle_timeout=10)
+        server.bind()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.close)
+        self.assertTrue(agent.ping(path))
+        for i in range(2):
+            out = StringIO()
+            self.assertEqual(agent.forward(['apps', '-l'], path, out), 0)
+            self.assertEqual(out.getvalue(), 'ok /v1/applications\n')
+        self.assertEqual(self.server.connections, 1)
+        out = StringIO()
+        self.assertEqual(agent.forward(['apps', '--bogus'], path, out), 2)
+        self.assertIn('no such option', out.getvalue())
+        # commands needing the terminal or stdin run in the client
+        for args in (['shell'], ['deploy'], ['batch', '-'], ['agent']):
+            self.assertEqual(agent.forward(args, path, out), None)
+        self.writeFile('apps -l\n["addons", "-l"]\n', self.wd, 'list.txt')
+        self.assertTrue(agent.forwardable(['batch', 'list.txt']))
+        self.assertTrue(agent.forwardable(['batch', '-k', 'list.txt'],
+                                          self.wd))
+        # a batch running a command which needs the terminal
+        self.writeFile('apps -l\ndeploy\n', self.wd, 'deploy.txt')
+        self.assertFalse(agent.forwardable(['batch', 'deploy.txt']))
+        self.assertEqual(agent.forward(['batch', 'deploy.txt'], path, out),
+                         None)
+        self.assertFalse(agent.forwardable(['batch', 'missing.txt']))
+        # the agent refuses it too, e.g. when sent by an older client
+        sock = agent.connect(path)
+        rfile, wfile = agent.files(sock)
+        agent.send(wfile, args=['batch', 'deploy.txt'], cwd=self.wd, env={})
+        self.assertIn('can not run in the agent',
+                      agent.receive(rfile)['output'])
+        self.assertEqual(agent.receive(rfile), {'exit': 1})
+        sock.close()
+        self.assertEqual(agent.stop(path), 'Agent stopped (pid %s)' %
+                                           os.getpid())
+        thread.join(5)
+        self.assertFalse(os.path.exists(path))
+
+    def test_batch_stop_on_error(self):
+        filename = self.writeFile('''
+unknown
+apps -l
+''', self.wd, 'commands.txt')
+        self.assertRaises(SystemExit, run, 'batch', filename)
+        self.assertEqual(self.server.requests, [])
+        self.assertRaises(SystemExit, run, 'batch', '-k', filename)
+        self.assertEqual(self.server.requests, [('GET', '/v1/applications')])
+
+    def test_profile(self):
+        import pstats
+        filename = join(self.wd, 'apps.prof')
+        run('--profile=%s' % filename, 'apps', '-l')
+        stats = pstats.Stats(filename)
+        self.assertTrue([f for f in stats.stats if f[2] == 'request'])
+        filename = join(self.wd, 'apps.folded')
+        run('--profile=%s' % filename, 'apps', '-l')
+        self.assertTrue(os.path.isfile(filename))
@@ -2,8 +2,206 @@
 import unittest2 as unittest
 from cStringIO import StringIO
 from os.path import join
+from testing import TestCase
 from pytheon import utils
 import tempfile
+import json
 import shutil
 import os
 
+
+class TestJSON(TestCase):
+
+    data = {'name': 'app', 'addons': [{'name': 'mysql'}, 'redis'],
+            'owner': {'email': 'user@example.com', 'keys': []}}
+
+    def test_attributes(self):
+        for obj in (utils.JSON(self.data), utils.JSONView(self.data)):
+            self.assertEqual(obj.name, 'app')
+            self.assertEqual(obj.missing, None)
+            self.assertEqual(obj.owner.email, 'user@example.com')
+            self.assertEqual(sorted(obj.owner.keys()), ['email', 'keys'])
+            self.assertEqual(obj.addons[0].name, 'mysql')
+            self.assertEqual(obj.addons[1:], ['redis'])
+            self.assertEqual([a for a in obj.addons][1], 'redis')
+            self.assertEqual(obj.owner, self.data['owner'])
+
+    def test_json_values_are_plain(self):
+        obj = utils.JSON(self.data)
+        self.assertEqual(json.loads(json.dumps(obj.owner)), self.data['owner'])
+        self.assertEqual(obj.addons + [], [{'name': 'mysql'}, 'redis'])
+        self.assertTrue(isinstance(obj.owner, utils.JSON))
+        self.assertEqual(sorted(obj.owner.values(), key=str),
+                         [[], 'user@example.com'])
+
+    def test_view_is_not_a_copy(self):
+        view = utils.JSONView(self.data)
+        self.assertTrue(view.owner._data is self.data['owner'])
+        self.assertTrue(view.owner is view.owner)
+        self.assertTrue(view.addons[0] is view.addons[0])
+        self.assertRaises(KeyError, view.__getitem__, 'missing')
+        self.assertRaises(AttributeError, setattr, view, 'name', 'other')
+        self.assertEqual(str(utils.JSONView('{"a": 1}')), '{"a": 1}')
+
+    def test_view_keys_are_not_hidden(self):
+        view = utils.JSONView({'data': 1, 'children': [{'child': 2}]})
+        self.assertEqual(view.data, 1)
+        self.assertEqual(view.children[0].child, 2)
+        self.assertEqual(utils.JSONView({'items': [1]}).items(),
+                         [('items', [1])])
+
+    def test_view_mapping_methods(self):
+        view = utils.JSONView(self.data)
+        self.assertEqual(sorted(view.values(), key=str),
+                         sorted(utils.JSON(self.data).values(), key=str))
+        self.assertTrue(view.values()[0] is view.values()[0])
+        self.assertEqual(sorted(view.iterkeys()), sorted(self.data))
+        self.assertEqual(dict(view.iteritems()), self.data)
+        self.assertEqual(len(list(view.itervalues())), 3)
+        self.assertTrue(view.has_key('owner'))
+
+
+class TestConfig(TestCase):
+
+    def test_user_config_is_cached(self):
+        config = utils.user_config()
+        self.assertTrue(config is utils.user_config())
+        self.assertEqual(config.pytheon.api_host, 'localshost:6543')
+
+    def test_user_config_reloaded_when_changed(self):
+        config = utils.user_config()
+        self.writeFile('''
+[pytheon]
+api_host = api.example.com:443
+''', self.home, '.pytheonrc')
+        new_config = utils.user_config()
+        self.assertFalse(config is new_config)
+        self.assertEqual(new_config.pytheon.api_host, 'api.example.com:443')
+
+    def test_atomic_write(self):
+        config = utils.user_config()
+        config.pytheon.username = 'user@example.com'
+        config.write()
+        self.assertTrue(config is utils.user_config())
+        self.assertEqual(os.listdir(self.home), ['.pytheonrc'])
+        config = utils.Config.from_file(join(self.home, '.pytheonrc'))
+        self.assertEqual(config.pytheon.username, 'user@example.com')
+
+    def test_sql_url_is_cached(self):
+        for key in ('PG_URL', 'MYSQL_URL', 'SQLITE_URL'):
+            self.addCleanup(os.environ.pop, key, None)
+            os.environ.pop(key, None)
+        self.addCleanup(utils.sql_urls.clear)
+        calls = []
+
+        def find_database(client):
+            calls.append(client.user)
+            return 'db%s' % len(calls)
+
+        self.addCleanup(setattr, utils, 'find_database', utils.find_database)
+        utils.find_database = find_database
+        cnf = self.writeFile('[client]\nuser = u\npassword = p\n',
+                             self.home, '.my.cnf')
+        url = 'mysql://u:p@127.0.0.1:3306/db1'
+        self.assertEqual(utils.get_sql_url(), url)
+        self.assertEqual(os.environ['MYSQL_URL'], url)
+        # the database found on the server is cached on disk
+        del os.environ['MYSQL_URL']
+        utils.sql_urls.clear()
+        self.assertEqual(utils.get_sql_url(), url)
+        self.assertEqual(calls, ['u'])
+        del os.environ['MYSQL_URL']
+        self.writeFile('[client]\nuser = v\npassword = p\n', cnf)
+        os.utime(cnf, (0, 0))
+        self.assertEqual(utils.get_sql_url(), 'mysql://v:p@127.0.0.1:3306/db2')
+        self.assertEqual(calls, ['u', 'v'])
+
+    def test_sql_url_failure_is_not_cached(self):
+        for key in ('PG_URL', 'MYSQL_URL', 'SQLITE_URL'):
+            self.addCleanup(os.environ.pop, key, None)
+            os.environ.pop(key, None)
+        self.addCleanup(utils.sql_urls.clear)
+        found = [None]
+        self.addCleanup(setattr, utils, 'find_database', utils.find_database)
+        utils.find_database = lambda client: found[0]
+        self.writeFile('[client]\nuser = u\npassword = p\n',
+                       self.home, '.my.cnf')
+        self.assertEqual(utils.get_sql_url(), None)
+        # the server is up now
+        found[0] = 'db'
+        self.assertEqual(utils.get_sql_url(), 'mysql://u:p@127.0.0.1:3306/db')
+
+
+class TestEngines(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.addCleanup(utils.dispose_engines)
+        self.config = {'sqlalchemy.url': 'sqlite:///%s' % self.db}
+
+    def engine(self, **params):
+        from sqlalchemy.pool import QueuePool
+        return utils.engine_from_config(dict(self.config), poolclass=QueuePool,
+                                        **params)
+
+    def test_registry(self):
+        engine = self.engine(pool_size=2)
+        self.assertTrue(engine is self.engine(pool_size=2))
+        self.assertFalse(engine is self.engine(pool_size=3))
+        self.assertEqual(engine.pool.size(), 2)
+
+    def test_engine_dict(self):
+        # no engine is created so the driver is not needed
+        self.addCleanup(os.environ.pop, 'MYSQL_URL', None)
+        os.environ['MYSQL_URL'] = 'mysql+nodriver://u:p@db.local:3307/app'
+        self.assertEqual(utils.engine_dict(), dict(
+            drivername='mysql+nodriver', username='u', password='p',
+            host='db.local', port=3307, database='app'))
+        self.assertEqual(utils.engines, {})
+
+    def test_pool_options(self):
+        config = utils.Config()
+        config.deploy.sql_pool_size = '10'
+        config.deploy.sql_pool_pre_ping = 'true'
+        self.assertEqual(utils.pool_options(config),
+                         dict(pool_size=10, pool_pre_ping=True))
+        self.assertEqual(utils.pool_options(), {})
+        self.writeFile('[deploy]\nsql_pool_recycle = 3600\n',
+                       self.wd, 'deploy.ini')
+        self.assertEqual(utils.pool_options(), dict(pool_recycle=3600))
+
+    def test_pool_stats(self):
+        engine = self.engine(pool_size=2)
+        conn = engine.connect()
+        engine.connect().close()
+        stats = utils.pool_stats()[0]
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['max_checked_out'], 2)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['connects'], 2)
+        self.assertEqual(stats['size'], 2)
+        self.assertIn('Pool size: 2', stats['pool'])
+        conn.close()
+        self.assertEqual(utils.pool_stats()[0]['checked_out'], 0)
+
+    def test_fork(self):
+        engine = self.engine()
+        engine.execute('SELECT 1')
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                # a connection of the parent is discarded
+                engine.execute('SELECT 1')
+                stats = utils.pool_stats()[0]
+                if stats['discarded'] == 1 and stats['connects'] == 2:
+                    # the pool is replaced on the next use of the registry
+                    pool = engine.pool
+                    self.engine()
+                    if engine.pool is not pool:
+                        status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+        self.assertEqual(utils.pool_stats()[0]['discarded'], 0)